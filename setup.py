@@ -12,8 +12,9 @@ setup(
     description='A Python package to create MBTiles from Slippy Map tileservers.',
     long_description=open('README.md', 'rt').read(),
     install_requires=[
-        GDAL
-        Pillow
+        'GDAL',
+        'Pillow',
+        'numpy',
     ],
     entry_points={
         'console_scripts': [
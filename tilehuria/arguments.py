@@ -31,7 +31,7 @@ def argumentlist():
      'Color space of tile format: RGB or YCBCR.',
      'RGB'),
     ('q', 'quality', None,
-     'JPEG compression quality setting.', None),
+     'JPEG compression quality setting.', 70),
     ('t', 'type', None,
      'Layer type: overlay or baselayer.',
      'overlay'),
@@ -55,6 +55,95 @@ def argumentlist():
      None),
     ('od', 'output_dir', None,
      'Output directory for read or downloaded tiles',
+     None),
+    ('em', 'enumeration', None,
+     'Method of finding tiles in the AOI: quadtree, scanline, or bruteforce',
+     'quadtree'),
+    ('csv', 'write_csv', 'store_true',
+     'Write the list of tiles (with WKT outlines) to a CSV file rather than '
+     'streaming them straight into the downloader',
+     None),
+    ('dl', 'downloader', None,
+     'Download backend: pooled (persistent keep-alive connections to each '
+     'tile host), urllib (a new connection for every tile), or async '
+     '(asyncio, with the number of downloads in flight adjusted to what '
+     'the server can take)',
+     'pooled'),
+    ('con', 'connections', None,
+     'Maximum number of connections to each tile host',
+     8),
+    ('mc', 'max_concurrency', None,
+     'Maximum number of downloads in flight at once with the async downloader',
+     1000),
+    ('ma', 'max_attempts', None,
+     'Number of times to try downloading a tile before giving up on it',
+     3),
+    ('nj', 'no_journal', 'store_true',
+     'Do not keep a journal of finished tiles (by default an interrupted '
+     'job picks up where it left off when run again)',
+     None),
+    ('dm', 'direct', 'store_true',
+     'Put downloaded tiles straight into the MBTiles file rather than into '
+     'a folder of tiles first',
+     None),
+    ('dd', 'dedupe', 'store_true',
+     'Store identical tiles (ocean, blank imagery) only once in the '
+     'MBTiles file, using the map/images layout',
+     None),
+    ('pr', 'processes', None,
+     'Number of processes to compress tiles with (default: one per '
+     'CPU core)',
+     None),
+    ('up', 'update', 'store_true',
+     'Add to an existing MBTiles file (for a bigger area, or another '
+     'zoom level), downloading only the tiles it does not have yet',
+     None),
+    ('sc', 'blank_solid', 'store_true',
+     'Treat tiles which are all one colour as blank "no imagery" tiles',
+     None),
+    ('bh', 'blank_hashes', None,
+     'SHA-1 hashes of the tileserver\'s "no imagery" placeholder tiles, '
+     'comma-separated, or a file of them, one per line',
+     None),
+    ('bb', 'blank_bytes', None,
+     'Treat tiles this many bytes or smaller as blank (a rough guess, '
+     'which also drops real tiles that compress well)',
+     None),
+    ('cd', 'cache_dir', None,
+     'Directory of the tile cache shared by all jobs (default: '
+     '~/.cache/tilehuria)',
+     None),
+    ('cx', 'cache_size', None,
+     'Largest size of the tile cache in MB; the least recently used tiles '
+     'are thrown out beyond that',
+     2000),
+    ('ct', 'cache_ttl', None,
+     'Days a cached tile is used before checking with the server whether '
+     'it has changed',
+     30),
+    ('nc', 'no_cache', 'store_true',
+     'Do not use the tile cache',
+     None),
+    ('rl', 'rate_limit', None,
+     'Most requests per second to each tile host (default: the rate= '
+     'property of the tileserver, or no limit)',
+     None),
+    ('tr', 'total_rate', None,
+     'Most requests per second to the tileserver as a whole, across all '
+     'of its hosts (default: its total_rate= property, or no limit)',
+     None),
+    ('rf', 'refresh', 'store_true',
+     'Bring an existing MBTiles file up to date: ask the server for each '
+     'tile only if it has changed since it was downloaded, and rewrite '
+     'only the tiles that have',
+     None),
+    ('rp', 'report', None,
+     'JSON file to write the measurements of the run to (default: '
+     '<AOI name>_<tileserver>_report.json)',
+     None),
+    ('ep', 'enumeration_processes', None,
+     'Number of processes to find the tiles in the AOI with (default: one '
+     'per CPU core)',
      None)
     ]
     return arguments
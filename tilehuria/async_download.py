@@ -0,0 +1,334 @@
+#!/usr/bin/python3
+"""
+An asyncio download engine for tiles, as an alternative to a fixed number of
+download threads.
+
+Any number of downloads can be in flight on a single thread. How many are
+in flight at once is set by an AIMD (additive increase, multiplicative
+decrease) controller, much like TCP congestion control: the limit creeps up
+by one for every window of healthy responses, and is halved when the server
+shows signs of distress (timeouts, HTTP 429 Too Many Requests, or HTTP 5xx).
+
+The HTTP/1.1 client here is deliberately minimal (GET only, keep-alive,
+Content-Length or chunked bodies) to avoid any dependency beyond the
+standard library.
+"""
+import sys, os
+import asyncio
+import ssl
+import time
+from urllib.parse import urlsplit
+
+from http_pool import TileResponse, USER_AGENT
+from http_pool import retryable, describe_failure
+from work_queue import attempt_timeout, store_or_stop
+
+class AIMDController:
+    """Additive increase, multiplicative decrease of the number of downloads
+       allowed in flight at once"""
+
+    def __init__(self, initial = 16, minimum = 1, maximum = 1000,
+                 decrease = 0.5, latency_tolerance = 2.0,
+                 max_error_rate = 0.05):
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.decrease = decrease
+        self.latency_tolerance = latency_tolerance
+        self.max_error_rate = max_error_rate
+        self.in_flight = 0
+        self.base_latency = None   # fastest response seen
+        self.latency = None        # smoothed (moving average) latency
+        self.error_rate = 0.0      # smoothed rate of congestion signals
+        self.last_decrease = 0.0
+        self.peak = self.limit
+        self.decreases = 0
+        self.condition = asyncio.Condition()
+
+    def healthy(self, latency):
+        """True if latency and error rate are low enough to add concurrency"""
+        return (latency <= self.base_latency * self.latency_tolerance
+                and self.error_rate <= self.max_error_rate)
+
+    def update(self, latency, congested):
+        """Adjust the limit after a response (or timeout)"""
+        self.error_rate = 0.9 * self.error_rate + (0.1 if congested else 0.0)
+        if congested:
+            # Back off once per round trip, not once for every request
+            # caught in the same burst of failures
+            now = time.monotonic()
+            if now - self.last_decrease > (self.latency or latency):
+                self.limit = max(self.minimum, self.limit * self.decrease)
+                self.last_decrease = now
+                self.decreases += 1
+            return
+        if self.base_latency is None or latency < self.base_latency:
+            self.base_latency = latency
+        self.latency = (latency if self.latency is None
+                        else 0.9 * self.latency + 0.1 * latency)
+        if self.healthy(latency):
+            # One more in flight for every window's worth of responses
+            self.limit = min(self.maximum, self.limit + 1.0 / self.limit)
+            self.peak = max(self.peak, self.limit)
+
+    async def acquire(self):
+        """Wait until another download is allowed in flight"""
+        async with self.condition:
+            await self.condition.wait_for(
+                lambda: self.in_flight < int(self.limit))
+            self.in_flight += 1
+
+    async def release(self, latency, congested):
+        """Mark a download as finished and adjust the limit. latency is how
+           long the request to the server took, or None if none was made
+           (the tile was in the cache, say), which leaves the limit as it
+           is."""
+        async with self.condition:
+            self.in_flight -= 1
+            if latency is not None:
+                self.update(latency, congested)
+            self.condition.notify_all()
+
+class AsyncConnectionPool:
+    """Keep-alive connections reused across requests to the same host, at
+       most max_per_host at once per host. Requests to a host which has
+       max_per_host connections busy wait for one of them to finish. Every
+       request is recorded in Metrics if given, timed from when it has a
+       connection."""
+
+    def __init__(self, max_per_host = 8, metrics = None):
+        self.max_per_host = max(1, int(max_per_host))
+        self.metrics = metrics
+        self.idle = {}   # (scheme, host, port): list of (reader, writer)
+        self.slots = {}  # (scheme, host, port): semaphore of connections
+        self.ssl_context = ssl.create_default_context()
+        self.opened = 0
+        self.requests = 0
+
+    async def _read_response(self, reader):
+        """Read status, headers and body. Returns (status, headers,
+           data, whether the connection can be reused)"""
+        line = await reader.readline()
+        if not line:
+            raise ConnectionResetError('Connection closed by server')
+        statusline = line.decode('latin-1').split(None, 2)
+        (version, status) = (statusline[0], int(statusline[1]))
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            (name, sep, value) = line.decode('latin-1').partition(':')
+            headers[name.strip()] = value.strip()
+        lowered = {name.lower(): value for (name, value) in headers.items()}
+
+        keepalive = (version == 'HTTP/1.1' and
+                     lowered.get('connection', '').lower() != 'close')
+        if status in (204, 304):
+            data = b''
+        elif 'chunked' in lowered.get('transfer-encoding', '').lower():
+            chunks = []
+            while True:
+                size = int((await reader.readline()).split(b';')[0], 16)
+                if size == 0:
+                    # Skip any trailers
+                    while (await reader.readline()) not in (b'\r\n', b'\n',
+                                                            b''):
+                        pass
+                    break
+                chunks.append(await reader.readexactly(size))
+                await reader.readexactly(2)
+            data = b''.join(chunks)
+        elif 'content-length' in lowered:
+            data = await reader.readexactly(int(lowered['content-length']))
+        else:
+            data = await reader.read()
+            keepalive = False
+        return (status, headers, data, keepalive)
+
+    async def _exchange(self, reader, writer, request):
+        writer.write(request)
+        await writer.drain()
+        return await self._read_response(reader)
+
+    async def fetch(self, url, timeout, headers = None):
+        """Download a URL, return a TileResponse"""
+        parts = urlsplit(url)
+        https = parts.scheme == 'https'
+        port = parts.port or (443 if https else 80)
+        key = (parts.scheme, parts.hostname, port)
+        path = parts.path or '/'
+        if parts.query:
+            path = '{}?{}'.format(path, parts.query)
+        lines = ['GET {} HTTP/1.1'.format(path),
+                 'Host: {}'.format(parts.netloc.rpartition('@')[2]),
+                 'User-Agent: {}'.format(USER_AGENT),
+                 'Accept-Encoding: identity',
+                 'Connection: keep-alive']
+        for (name, value) in (headers or {}).items():
+            lines.append('{}: {}'.format(name, value))
+        request = ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1')
+
+        if key not in self.slots:
+            self.slots[key] = asyncio.Semaphore(self.max_per_host)
+        queued = time.monotonic()
+        async with self.slots[key]:
+            start = time.monotonic()
+            try:
+                response = await self._fetch(key, parts, request, timeout)
+            except Exception as e:
+                if self.metrics:
+                    self.metrics.fetched(url, time.monotonic() - start,
+                                         error = e, wait = start - queued)
+                raise
+            if self.metrics:
+                self.metrics.fetched(url, time.monotonic() - start, response,
+                                     wait = start - queued)
+            return response
+
+    async def _fetch(self, key, parts, request, timeout):
+        (scheme, host, port) = key
+        self.requests += 1
+        idle = self.idle.setdefault(key, [])
+        # A reused connection may have been closed by the server while
+        # idle; in that case try once more on a fresh connection
+        for attempt in range(2):
+            reused = bool(idle)
+            if reused:
+                (reader, writer) = idle.pop()
+            else:
+                self.opened += 1
+                (reader, writer) = await asyncio.wait_for(
+                    asyncio.open_connection(host, port,
+                        ssl = self.ssl_context if scheme == 'https'
+                              else None), timeout)
+            try:
+                (status, response_headers, data, keepalive) = (
+                    await asyncio.wait_for(
+                        self._exchange(reader, writer, request), timeout))
+            except (ConnectionError, asyncio.IncompleteReadError):
+                writer.close()
+                if reused:
+                    continue
+                raise
+            except BaseException:
+                writer.close()
+                raise
+            if keepalive:
+                idle.append((reader, writer))
+            else:
+                writer.close()
+            return TileResponse(status, response_headers, data)
+        raise ConnectionError('Could not get a connection to {}'
+                              .format(parts.hostname))
+
+    def close(self):
+        """Close all idle connections"""
+        for idle in self.idle.values():
+            for (reader, writer) in idle:
+                writer.close()
+        self.idle = {}
+
+async def download_all(tilequeue, store, opts, cache = None,
+                       limiter = None, validators = None, metrics = None):
+    """Download every tile, as many at once as the controller allows,
+       looking in the TileCache first if one is given, and waiting for
+       its turn from the RateLimiter if one is given. With TileValidators,
+       only tiles which have changed are downloaded again. Requests are
+       recorded in Metrics if given."""
+    pool = AsyncConnectionPool(int(opts.get('connections') or 8), metrics)
+    controller = AIMDController(maximum = int(opts['max_concurrency']))
+    loop = asyncio.get_running_loop()
+    finished = asyncio.Event()   # set whenever a download finishes
+    tasks = set()
+
+    async def handle(tile, attempt):
+        (z, x, y, url) = tile
+        # Only the time the server takes is a sign of congestion, not the
+        # time spent waiting on the limiter, the cache or storing the tile
+        latency = None
+        (reason, retry, congested, state) = (None, True, False, None)
+        try:
+            # The cache reads and writes files and SQLite, so keep it off
+            # the loop too
+            cached = (await loop.run_in_executor(None, cache.get, z, x, y,
+                                                 url) if cache else None)
+            if cached and cached.fresh:
+                response = TileResponse(200, {}, cached.data)
+            else:
+                source = url
+                if limiter:
+                    (source, wait) = limiter.acquire(z, x, y, url)
+                    if wait > 0:
+                        await asyncio.sleep(wait)
+                headers = cache.validators(cached) if cache else {}
+                if validators:
+                    headers.update(validators.headers(z, x, y))
+                start = loop.time()
+                try:
+                    response = await pool.fetch(source,
+                                                attempt_timeout(attempt),
+                                                headers)
+                finally:
+                    latency = loop.time() - start
+                if limiter:
+                    limiter.feedback(source, response)
+                if cache:
+                    response = await loop.run_in_executor(
+                        None, cache.update, z, x, y, url, cached, response)
+            if response.status == 200:
+                # Storing may mean compressing the tile, or waiting for
+                # the MBTiles writer to catch up, so keep it off the loop
+                state = await loop.run_in_executor(None, store_or_stop,
+                                                   tilequeue, store, z, x, y,
+                                                   url, response)
+            elif response.status == 304:
+                state = 'unchanged'
+            elif response.status == 404:
+                # The server has no tile at this address
+                state = await loop.run_in_executor(None, store_or_stop,
+                                                   tilequeue, store, z, x, y,
+                                                   url, None)
+            else:
+                reason = 'HTTP {}'.format(response.status)
+                retry = retryable(response.status)
+                congested = response.status == 429 or response.status >= 500
+        except asyncio.TimeoutError:
+            (reason, congested) = ('timeout', True)
+        except Exception as e:
+            reason = describe_failure(e)
+        await controller.release(latency, congested)
+        tilequeue.done(tile, attempt, reason, retry, state)
+        finished.set()
+
+    while True:
+        (state, value) = tilequeue.poll()
+        if state == 'done':
+            break
+        if state == 'wait':
+            # Until a retry is due, or a download in flight finishes
+            finished.clear()
+            try:
+                await asyncio.wait_for(finished.wait(), value)
+            except asyncio.TimeoutError:
+                pass
+            continue
+        await controller.acquire()
+        task = asyncio.ensure_future(handle(*value))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+    pool.close()
+    return (controller, pool)
+
+def download_tiles_async(tilequeue, store, opts, cache = None,
+                         limiter = None, validators = None, metrics = None):
+    """Download tiles from a TileQueue on an asyncio event loop, handing
+       each successful download to store(z, x, y, url, rawdata, headers)"""
+    (controller, pool) = asyncio.run(download_all(tilequeue, store, opts,
+                                                  cache, limiter, validators,
+                                                  metrics))
+    if opts['verbose']:
+        print('{} requests used {} connections; at most {} in flight, '
+              'backed off {} times'.format(pool.requests, pool.opened,
+                                           int(controller.peak),
+                                           controller.decreases))
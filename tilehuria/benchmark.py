@@ -0,0 +1,392 @@
+#!/usr/bin/python3
+"""
+Benchmarks of the slow parts of the MBTile creation pipeline.
+
+Downloads are timed against a local stand-in tileserver (local_tileserver.py)
+so that the results measure this code rather than somebody else's server.
+The server can be made slow (latency), unreliable (error_rate) and patchy
+(blank_ratio, the share of tiles which are "no imagery" placeholders).
+
+Finding the tiles in an AOI is timed on the example AOI in example_files
+and on larger made-up round AOIs. Compression is timed on a folder of real
+JPEG tiles; MBTiles writing and reading on made-up tiles.
+
+Tile math (bounds, TMS rows and quadkeys) is timed one tile at a time with
+the functions in utils and write_mbtiles, and in batches with tile_math.
+
+The suite runs all of these at several numbers of tiles, and writes the
+results, along with the commit and the machine they were measured on, to a
+JSON file. compare shows the difference between two such files, so that a
+change which makes things slower is caught before it is merged. Each
+benchmark is run --repeats times and the fastest time kept, as the fastest
+run is the one least disturbed by whatever else the machine was doing.
+
+Example:
+    python3 benchmark.py download -n 5000 -l 0.01 -e 0.01 -b 0.2
+    python3 benchmark.py write -n 100000
+    python3 benchmark.py tilemath -n 10000000
+    python3 benchmark.py suite -s 10000,100000 -o before.json
+    python3 benchmark.py suite -s 10000,100000 -o after.json
+    python3 benchmark.py compare before.json after.json
+"""
+import sys, os
+import argparse
+import hashlib
+import json
+import math
+import platform
+import shutil
+import subprocess
+import tempfile
+import time
+import multiprocessing
+from functools import partial
+import numpy as np
+
+from local_tileserver import start_tileserver, make_tile, make_image_tile
+from local_tileserver import blank_tile
+from download_all_tiles_in_csv import download_tiles, store_tile
+from tileservers import TileServer
+from blank_tiles import BlankDetector
+from create_tile_list import generate_tile_list
+from convert_and_compress_tiles import convert_and_compress_tiles
+from read_mbtiles import read_mbtiles
+from utils import tiles_with_urls
+from write_mbtiles import write_mbtiles, increment_bounds, MBTilesWriter
+from utils import tile_coords_to_quadkey
+from tile_math import tile_bounds, flip_y, quadkeys
+
+EXAMPLE_AOI = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                           'example_files', 'San_Francisco_Shipyard.geojson')
+
+# AOIs for timing the enumeration: (name, radius in km or None for the
+# example AOI, minzoom, maxzoom)
+AOIS = [('shipyard', None, 16, 21),
+        ('town', 2.0, 16, 20),
+        ('city', 10.0, 16, 20)]
+
+DEFAULT_SIZES = '10000,100000,1000000'
+
+def synthetic_tiles(num_tiles, zoom = 18):
+    """Yield (zoom, x, y) for a square-ish block of num_tiles tiles"""
+    width = max(1, int(num_tiles ** 0.5))
+    for i in range(num_tiles):
+        yield (zoom, 100000 + i % width, 100000 + i // width)
+
+def write_aoi(path, lon, lat, radius_km, sides = 64):
+    """Write a round AOI (a polygon of many sides) as GeoJSON"""
+    ring = []
+    for i in range(sides + 1):
+        angle = 2 * math.pi * i / sides
+        ring.append([lon + radius_km / (111.32 * math.cos(math.radians(lat)))
+                     * math.cos(angle),
+                     lat + radius_km / 110.57 * math.sin(angle)])
+    aoi = {'type': 'FeatureCollection',
+           'features': [{'type': 'Feature', 'properties': {},
+                         'geometry': {'type': 'Polygon',
+                                      'coordinates': [ring]}}]}
+    with open(path, 'w') as f:
+        json.dump(aoi, f)
+
+def bench_enumerate(aoifile, minzoom, maxzoom, enumeration = 'quadtree'):
+    """Time finding every tile in an AOI. Returns (tiles, seconds)."""
+    start = time.time()
+    count = sum(1 for tile in generate_tile_list(aoifile, {
+        'minzoom': minzoom, 'maxzoom': maxzoom, 'enumeration': enumeration}))
+    return (count, time.time() - start)
+
+def bench_download(num_tiles, latency, downloaders = ('urllib', 'pooled',
+                                                     'async'),
+                   error_rate = 0.0, blank_ratio = 0.0, tile_size = 10000):
+    """Time downloading num_tiles tiles from a local tileserver with each
+       downloader backend, into a folder of tiles. Placeholder tiles are
+       recognised by their hash. Returns {downloader: seconds}."""
+    (server, url_template) = start_tileserver(latency = latency,
+                                              tile_size = tile_size,
+                                              error_rate = error_rate,
+                                              blank_ratio = blank_ratio)
+    tileserver = TileServer('benchmark', url_template, blank = [
+        hashlib.sha1(blank_tile()).hexdigest()])
+    results = {}
+    try:
+        for downloader in downloaders:
+            outdir = tempfile.mkdtemp(prefix = 'tilehuria_bench_')
+            tiles = tiles_with_urls(synthetic_tiles(num_tiles), url_template)
+            store = partial(store_tile, outdir, tileserver,
+                            BlankDetector(tileserver))
+            start = time.time()
+            download_tiles(tiles, outdir, {'downloader': downloader,
+                                           'no_cache': True,
+                                           'max_attempts': 10}, None, store)
+            results[downloader] = time.time() - start
+            shutil.rmtree(outdir)
+    finally:
+        server.shutdown()
+    return results
+
+def make_tile_folder(num_tiles, tile_size = 1000, images = False):
+    """Create a Slippy Map folder of made-up tiles, or of real JPEG images.
+       Returns its path."""
+    tiledir = os.path.join(tempfile.mkdtemp(prefix = 'tilehuria_bench_'),
+                           'tiles')
+    for (z, x, y) in synthetic_tiles(num_tiles):
+        path = os.path.join(tiledir, str(z), str(x))
+        os.makedirs(path, exist_ok = True)
+        data = (make_image_tile(z, x, y) if images
+                else make_tile(z, x, y, tile_size))
+        with open(os.path.join(path, '{}.jpeg'.format(y)), 'wb') as f:
+            f.write(data)
+    return tiledir
+
+def bench_compress(num_tiles, processes = None):
+    """Time convert_and_compress_tiles on a folder of num_tiles JPEG tiles,
+       recompressing them from quality 90 to 70. Returns seconds."""
+    tiledir = make_tile_folder(num_tiles, images = True)
+    try:
+        start = time.time()
+        convert_and_compress_tiles(tiledir, {'processes': processes})
+        elapsed = time.time() - start
+    finally:
+        shutil.rmtree(os.path.dirname(tiledir))
+    return elapsed
+
+def bench_write(num_tiles):
+    """Time write_mbtiles on a folder of num_tiles made-up tiles.
+       Returns seconds."""
+    tiledir = make_tile_folder(num_tiles)
+    try:
+        start = time.time()
+        write_mbtiles(tiledir, {})
+        elapsed = time.time() - start
+    finally:
+        shutil.rmtree(os.path.dirname(tiledir))
+    return elapsed
+
+def bench_read(num_tiles, tile_size = 1000):
+    """Time read_mbtiles on an MBTiles file of num_tiles made-up tiles.
+       Returns seconds."""
+    workdir = tempfile.mkdtemp(prefix = 'tilehuria_bench_')
+    mbtilesfile = os.path.join(workdir, 'tiles.mbtiles')
+    try:
+        writer = MBTilesWriter(mbtilesfile, {})
+        for (z, x, y) in synthetic_tiles(num_tiles):
+            writer.add(z, x, y, make_tile(z, x, y, tile_size), 'png')
+        writer.close()
+        start = time.time()
+        read_mbtiles(mbtilesfile, {'output_dir':
+                                   os.path.join(workdir, 'tiles')})
+        elapsed = time.time() - start
+    finally:
+        shutil.rmtree(workdir)
+    return elapsed
+
+def bench_tilemath(num_tiles, batch_size = 100000):
+    """Time working out the bounds, TMS row and quadkey of num_tiles random
+       tiles at zoom 12 to 20, one at a time and in batches. Returns
+       {method: microseconds per tile}."""
+    rng = np.random.default_rng(0)
+    zooms = rng.integers(12, 21, num_tiles)
+    tileXs = rng.integers(0, 2 ** 20, num_tiles) % (2 ** zooms)
+    tileYs = rng.integers(0, 2 ** 20, num_tiles) % (2 ** zooms)
+
+    start = time.time()
+    for (z, x, y) in zip(zooms.tolist(), tileXs.tolist(), tileYs.tolist()):
+        increment_bounds(z, x, y, 180.0, 85.05113, -180.0, -85.05113)
+        2 ** z - y - 1
+        tile_coords_to_quadkey(x, y, z)
+    scalar = time.time() - start
+
+    start = time.time()
+    for i in range(0, num_tiles, batch_size):
+        batch = slice(i, i + batch_size)
+        tile_bounds(tileXs[batch], tileYs[batch], zooms[batch])
+        flip_y(tileYs[batch], zooms[batch])
+        quadkeys(tileXs[batch], tileYs[batch], zooms[batch])
+    vectorized = time.time() - start
+    return {'one at a time': scalar / num_tiles * 1e6,
+            'batched': vectorized / num_tiles * 1e6}
+
+def environment():
+    """What the benchmarks were run on: the commit, Python, and machine"""
+    try:
+        commit = subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output = True,
+            text = True, cwd = os.path.dirname(os.path.abspath(__file__)),
+            check = True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {'commit': commit,
+            'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'platform': platform.platform(),
+            'machine': platform.machine(),
+            'cpus': multiprocessing.cpu_count()}
+
+def result(tiles, seconds):
+    return {'tiles': tiles, 'seconds': round(seconds, 4),
+            'tiles_per_second': round(tiles / seconds, 1) if seconds else None}
+
+def run_suite(sizes, latency = 0.0, error_rate = 0.0, blank_ratio = 0.0,
+              repeats = 1, processes = None):
+    """Run every benchmark at every number of tiles, keeping the fastest of
+       repeats runs of each. Returns {benchmark name: result}."""
+    results = {}
+    def record(name, tiles, timings):
+        results[name] = result(tiles, min(timings))
+        print('{:32} {:>10} tiles {:10.3f} s {:12.1f} tiles/s'.format(
+            name, tiles, results[name]['seconds'],
+            results[name]['tiles_per_second'] or 0.0))
+
+    workdir = tempfile.mkdtemp(prefix = 'tilehuria_bench_')
+    try:
+        for (name, radius, minzoom, maxzoom) in AOIS:
+            aoifile = EXAMPLE_AOI
+            if radius:
+                aoifile = os.path.join(workdir, '{}.geojson'.format(name))
+                write_aoi(aoifile, -122.42, 37.77, radius)
+            runs = [bench_enumerate(aoifile, minzoom, maxzoom)
+                    for i in range(repeats)]
+            record('enumerate/{}/z{}-{}'.format(name, minzoom, maxzoom),
+                   runs[0][0], [seconds for (tiles, seconds) in runs])
+    finally:
+        shutil.rmtree(workdir)
+
+    for num_tiles in sizes:
+        timings = {}
+        for i in range(repeats):
+            for (downloader, seconds) in bench_download(
+                    num_tiles, latency, ('pooled', 'async'), error_rate,
+                    blank_ratio, tile_size = 1000).items():
+                timings.setdefault(downloader, []).append(seconds)
+        for (downloader, runs) in timings.items():
+            record('download/{}/{}'.format(downloader, num_tiles),
+                   num_tiles, runs)
+        record('compress/{}'.format(num_tiles), num_tiles,
+               [bench_compress(num_tiles, processes) for i in range(repeats)])
+        record('write/{}'.format(num_tiles), num_tiles,
+               [bench_write(num_tiles) for i in range(repeats)])
+        record('read/{}'.format(num_tiles), num_tiles,
+               [bench_read(num_tiles) for i in range(repeats)])
+    return results
+
+def compare_results(before, after, threshold = 0.1):
+    """Print the change in speed of every benchmark in two suite results,
+       marking those more than threshold slower. Returns the number of
+       benchmarks which got slower."""
+    print('Before: commit {} on {} ({} CPUs)'.format(
+        before['environment']['commit'], before['environment']['platform'],
+        before['environment']['cpus']))
+    print('After:  commit {} on {} ({} CPUs)'.format(
+        after['environment']['commit'], after['environment']['platform'],
+        after['environment']['cpus']))
+    for key in ('platform', 'cpus', 'settings'):
+        if before['environment'].get(key) != after['environment'].get(key):
+            print('Warning: the {} differs, so the results may not be '
+                  'comparable'.format(key))
+    slower = 0
+    for name in sorted(set(before['results']) | set(after['results'])):
+        (old, new) = (before['results'].get(name), after['results'].get(name))
+        if not (old and new and old['seconds'] and new['seconds']):
+            print('{:32} only in {}'.format(name, 'after' if new else 'before'))
+            continue
+        change = new['seconds'] / old['seconds'] - 1
+        flag = ''
+        if change > threshold:
+            flag = '  SLOWER'
+            slower += 1
+        elif change < -threshold:
+            flag = '  faster'
+        print('{:32} {:10.3f} s -> {:10.3f} s {:+7.1f}%{}'.format(
+            name, old['seconds'], new['seconds'], 100 * change, flag))
+    return slower
+
+if __name__ == "__main__":
+    p = argparse.ArgumentParser()
+    p.add_argument('benchmark', choices = ['download', 'enumerate',
+                                           'compress', 'write', 'read',
+                                           'tilemath', 'suite', 'compare'],
+                   help = 'Which benchmark to run')
+    p.add_argument('results', nargs = '*',
+                   help = 'For compare: the before and after JSON files')
+    p.add_argument('-n', '--num_tiles', default = 2000,
+                   help = 'Number of tiles to use')
+    p.add_argument('-s', '--sizes', default = DEFAULT_SIZES,
+                   help = 'Comma-separated numbers of tiles for the suite')
+    p.add_argument('-l', '--latency', default = 0.0,
+                   help = 'Seconds the local tileserver waits per request')
+    p.add_argument('-e', '--error_rate', default = 0.0,
+                   help = 'Share of requests the local tileserver fails')
+    p.add_argument('-b', '--blank_ratio', default = 0.0,
+                   help = 'Share of tiles the local tileserver has no '
+                          'imagery for')
+    p.add_argument('-a', '--aoi', default = EXAMPLE_AOI,
+                   help = 'AOI file for the enumerate benchmark')
+    p.add_argument('-z', '--zooms', default = '16-20',
+                   help = 'Zoom levels for the enumerate benchmark')
+    p.add_argument('-pr', '--processes', default = None,
+                   help = 'Number of processes to compress tiles with')
+    p.add_argument('-r', '--repeats', default = 1,
+                   help = 'Times to run each benchmark in the suite, '
+                          'keeping the fastest')
+    p.add_argument('-o', '--output', default = None,
+                   help = 'JSON file to write the suite results to')
+    p.add_argument('-t', '--threshold', default = 0.1,
+                   help = 'For compare: how much slower (0.1 is 10%%) counts '
+                          'as slower')
+    opts = vars(p.parse_args())
+    num_tiles = int(opts['num_tiles'])
+    processes = int(opts['processes']) if opts['processes'] else None
+
+    if opts['benchmark'] == 'download':
+        results = bench_download(num_tiles, float(opts['latency']),
+                                 error_rate = float(opts['error_rate']),
+                                 blank_ratio = float(opts['blank_ratio']))
+        for (downloader, seconds) in results.items():
+            print('{:10} {:10.1f} tiles/s'.format(downloader,
+                                                  num_tiles / seconds))
+    elif opts['benchmark'] == 'enumerate':
+        (minzoom, maxzoom) = opts['zooms'].split('-')
+        (tiles, seconds) = bench_enumerate(opts['aoi'], int(minzoom),
+                                           int(maxzoom))
+        print('enumerate {} tiles {:10.1f} tiles/s'.format(tiles,
+                                                           tiles / seconds))
+    elif opts['benchmark'] == 'compress':
+        seconds = bench_compress(num_tiles, processes)
+        print('convert_and_compress_tiles {:10.1f} tiles/s'.format(
+            num_tiles / seconds))
+    elif opts['benchmark'] == 'write':
+        seconds = bench_write(num_tiles)
+        print('write_mbtiles {:10.1f} tiles/s'.format(num_tiles / seconds))
+    elif opts['benchmark'] == 'read':
+        seconds = bench_read(num_tiles)
+        print('read_mbtiles {:10.1f} tiles/s'.format(num_tiles / seconds))
+    elif opts['benchmark'] == 'tilemath':
+        results = bench_tilemath(num_tiles)
+        for (method, cost) in results.items():
+            print('{:14} {:8.3f} microseconds per tile'.format(method, cost))
+    elif opts['benchmark'] == 'suite':
+        settings = {'sizes': [int(n) for n in opts['sizes'].split(',')],
+                    'latency': float(opts['latency']),
+                    'error_rate': float(opts['error_rate']),
+                    'blank_ratio': float(opts['blank_ratio']),
+                    'repeats': int(opts['repeats']),
+                    'processes': processes}
+        env = environment()
+        env['settings'] = settings
+        results = run_suite(**settings)
+        output = opts['output'] or 'benchmark_{}.json'.format(
+            env['commit'] or time.strftime('%Y%m%d%H%M%S'))
+        with open(output, 'w') as f:
+            json.dump({'environment': env, 'results': results}, f,
+                      indent = 2, sort_keys = True)
+        print('Results written to {}'.format(output))
+    elif opts['benchmark'] == 'compare':
+        if len(opts['results']) != 2:
+            p.error('compare needs the before and after JSON files')
+        with open(opts['results'][0]) as f:
+            before = json.load(f)
+        with open(opts['results'][1]) as f:
+            after = json.load(f)
+        slower = compare_results(before, after, float(opts['threshold']))
+        sys.exit(1 if slower else 0)
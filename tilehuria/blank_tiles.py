@@ -0,0 +1,132 @@
+#!/usr/bin/python3
+"""
+Recognise the "no imagery here" placeholder tiles that tileservers send in
+place of real tiles.
+
+A tile is blank if:
+- it is empty;
+- the SHA-1 hash of its bytes is one of the tileserver's known placeholders
+  (the blank= property in URL_formats.txt, the hashes listed for its name
+  or its URL template in blank_tiles.txt, or the hashes given with the
+  blank_hashes option);
+- solid colour checking is on, and every pixel of the tile is the same
+  colour;
+- a size cutoff is given, and the tile is no bigger than that (the old
+  heuristic, which also throws away real tiles that compress well).
+
+Verdicts are cached by hash for the run, so a placeholder that turns up
+again and again is only ever decoded once.
+"""
+import sys, os
+import io
+import hashlib
+import threading
+from collections import OrderedDict
+
+from PIL import Image
+
+BLANK_HASHES_FILE = os.path.join(os.path.dirname(__file__), 'blank_tiles.txt')
+
+def fingerprint(rawdata):
+    """The hash tiles are known by"""
+    return hashlib.sha1(rawdata).hexdigest()
+
+def is_solid_colour(rawdata):
+    """True if every pixel of an image is the same colour"""
+    im = Image.open(io.BytesIO(rawdata))
+    extrema = im.getextrema()
+    if not isinstance(extrema[0], tuple):  # single band
+        extrema = (extrema,)
+    return all(low == high for (low, high) in extrema)
+
+def read_hashes(lines):
+    """The hashes in lines of text: the first word of each line, leaving
+       out blank lines and lines starting with #"""
+    words = [line.split() for line in lines]
+    return set(w[0].lower() for w in words if w and not w[0].startswith('#'))
+
+def known_placeholders(server, hashfile = BLANK_HASHES_FILE):
+    """The hashes listed for a tileserver in a file of lines of a
+       tileserver name or URL template and its placeholders' hashes"""
+    if server is None or not os.path.exists(hashfile):
+        return set()
+    hashes = set()
+    with open(hashfile) as f:
+        for line in f:
+            entry = line.split()
+            if (len(entry) > 1 and not entry[0].startswith('#') and
+                entry[0] in (server.name, server.url_template)):
+                hashes.update(h.lower() for h in entry[1:])
+    return hashes
+
+def parse_blank_hashes(value):
+    """The hashes of the blank_hashes option: a file of them, one per line,
+       or else a comma-separated list"""
+    if not value:
+        return set()
+    if os.path.isfile(value):
+        with open(value) as f:
+            return read_hashes(f)
+    return read_hashes(value.split(','))
+
+class BlankDetector:
+    """Decides which tiles are placeholders. Safe to share between threads."""
+
+    def __init__(self, server = None, solid = False, max_bytes = None,
+                 cache_size = 10000, hashes = ()):
+        self.placeholders = set(server.blank) if server else set()
+        self.placeholders.update(known_placeholders(server))
+        self.placeholders.update(hashes)
+        self.solid = solid
+        self.max_bytes = int(max_bytes) if max_bytes else None
+        self.cache_size = cache_size
+        self.verdicts = OrderedDict()  # hash: blank or not, most recent last
+        self.seen = {}    # hash: number of times a placeholder was seen
+        self.lock = threading.Lock()
+
+    def is_blank(self, rawdata):
+        """True if a downloaded tile is really a blank 'no tile here' tile"""
+        if not rawdata:
+            return True
+        if self.max_bytes and len(rawdata) <= self.max_bytes:
+            return True
+        tile_hash = fingerprint(rawdata)
+        with self.lock:
+            if tile_hash in self.placeholders:
+                self.seen[tile_hash] = self.seen.get(tile_hash, 0) + 1
+                return True
+            verdict = self.verdicts.get(tile_hash)
+            if verdict is not None:
+                self.verdicts.move_to_end(tile_hash)
+                return verdict
+        if not self.solid:
+            return False
+        try:
+            blank = is_solid_colour(rawdata)
+        except Exception:
+            blank = False   # not an image; leave that to the compression
+        with self.lock:
+            if blank:
+                # Recognised by its hash from now on, and never forgotten
+                self.placeholders.add(tile_hash)
+                self.seen[tile_hash] = self.seen.get(tile_hash, 0) + 1
+            else:
+                self.verdicts[tile_hash] = False
+                if len(self.verdicts) > self.cache_size:
+                    self.verdicts.popitem(last = False)
+        return blank
+
+    def report(self):
+        """Print how often each placeholder was seen, most common first, so
+           that they can be added to blank_tiles.txt or the tileserver's
+           blank= property"""
+        for (tile_hash, count) in sorted(self.seen.items(),
+                                         key = lambda item: -item[1]):
+            print('Placeholder tile {} seen {} times'.format(tile_hash, count))
+
+def get_blank_detector(opts, server = None):
+    """A BlankDetector set up from the options"""
+    return BlankDetector(server, solid = bool(opts.get('blank_solid')),
+                         max_bytes = opts.get('blank_bytes'),
+                         hashes = parse_blank_hashes(
+                             opts.get('blank_hashes')))
@@ -1,10 +1,25 @@
 #!/usr/bin/python3
 """Batch convert and compress image tiles for the efficient creation of MBTiles
+
+Tiles are transcoded to the format, colorspace and quality in the options,
+skipping any that are already good enough, on a pool of processes (one per
+CPU core by default) each taking the files a chunk at a time. The results
+can be handed straight to an MBTilesWriter, so that they need not be read
+from disk again.
 """
 import sys, os
 import argparse
+import io
+import glob
+import multiprocessing
+from functools import partial
 from PIL import Image
 
+sys.path.insert(0, os.path.dirname(__file__))
+from arguments import argumentlist, set_defaults
+from write_mbtiles import path_to_zxy
+from metrics import Metrics, Progress
+
 def scandir(dir):
     filelist = []
     for path, dirs, files in os.walk(dir):
@@ -12,27 +27,148 @@ def scandir(dir):
             filelist.append(os.path.join(path, f))
     return filelist
 
-def convert_and_compress_tiles(indir):
-    image_files = scandir(indir)
+def tile_files(indir, tiles):
+    """The files in a Slippy Map folder of an iterable of (zoom, x, y)
+       tiles, whatever their extension"""
+    files = []
+    for (z, x, y) in tiles:
+        files.extend(glob.glob(os.path.join(glob.escape(indir), str(z), str(x),
+                                            '{}.*'.format(y))))
+    return files
+
+# The example luminance quantization table from the JPEG standard (Annex K),
+# which libjpeg (and so PIL) scales to get the table for each quality setting
+STANDARD_LUMINANCE_TABLE = [
+    16, 11, 10, 16, 24, 40, 51, 61,     12, 12, 14, 19, 26, 58, 60, 55,
+    14, 13, 16, 24, 40, 57, 69, 56,     14, 17, 22, 29, 51, 87, 80, 62,
+    18, 22, 37, 56, 68, 109, 103, 77,   24, 35, 55, 64, 81, 104, 113, 92,
+    49, 64, 78, 87, 103, 121, 120, 101, 72, 92, 95, 98, 112, 100, 103, 99]
+
+def jpeg_quality(im):
+    """Estimate the quality setting a JPEG was saved with from its
+       luminance quantization table, without decoding it. Returns None
+       if the image has no quantization tables."""
+    tables = getattr(im, 'quantization', None)
+    if not tables or 0 not in tables:
+        return None
+    scale = 100.0 * sum(tables[0]) / sum(STANDARD_LUMINANCE_TABLE)
+    quality = (200 - scale) / 2 if scale <= 100 else 5000 / scale
+    return max(1, min(100, int(round(quality))))
+
+def has_transparency(im):
+    """True if any pixel of a (decoded) image is not fully opaque"""
+    if im.mode == 'P' and 'transparency' in im.info:
+        im = im.convert('RGBA')
+    if im.mode in ('RGBA', 'LA', 'PA'):
+        return im.getchannel('A').getextrema()[0] < 255
+    return False
+
+def compress_tile(rawdata, optsin = {}):
+    """Transcode the bytes of an image tile to the format, colorspace and
+       quality in the options. Returns the new bytes and their file
+       extension.
+
+       JPEGs already at or below the target quality are passed through
+       untouched, as are PNGs when the target is PNG. Tiles with any
+       transparency stay PNG, whatever the target format. Each tile is
+       decoded at most once."""
+    tileformat = (optsin.get('format') or 'JPG').upper()
+    colorspace = (optsin.get('colorspace') or 'RGB').upper()
+    quality = int(optsin.get('quality') or 70)
+    target = 'png' if tileformat == 'PNG' else 'jpeg'
+
+    # Opening an image only reads its header
+    im = Image.open(io.BytesIO(rawdata))
+    if im.format == 'JPEG' and target == 'jpeg':
+        estimate = jpeg_quality(im)
+        if estimate is not None and estimate <= quality:
+            return (rawdata, 'jpeg')
+    if im.format == 'PNG' and target == 'png':
+        return (rawdata, 'png')
+
+    im.load()
+    output = io.BytesIO()
+    if target == 'png' or has_transparency(im):
+        if im.mode not in ('RGB', 'RGBA', 'L', 'LA', 'P'):
+            im = im.convert('RGBA')
+        im.save(output, 'PNG')
+        return (output.getvalue(), 'png')
+    im = im.convert('YCbCr' if colorspace == 'YCBCR' else 'RGB')
+    im.save(output, 'JPEG', quality = quality)
+    return (output.getvalue(), 'jpeg')
+
+def compress_file(image_file, opts = {}):
+    """Transcode one tile file, replacing it with the result. Returns
+       (image_file, new bytes, extension), or (image_file, None, None)
+       if it is not a valid image."""
+    (image_filename, image_ext) = os.path.splitext(image_file)
+    try:
+        with open(image_file, 'rb') as f:
+            rawdata = f.read()
+        (data, imtype) = compress_tile(rawdata, opts)
+    except Exception:
+        return (image_file, None, None)
+    outfile = '{}.{}'.format(image_filename, imtype)
+    if data is not rawdata or outfile != image_file:
+        with open(outfile, 'wb') as f:
+            f.write(data)
+    if outfile != image_file:
+        os.remove(image_file)
+    return (image_file, data, imtype)
+
+def convert_and_compress_tiles(indir, optsin = {}, writer = None,
+                               metrics = None, tiles = None):
+    """Transcode every tile in a folder, in parallel, or only the (zoom,
+       x, y) tiles given. If an MBTilesWriter is given, the compressed
+       tiles are also added to it. Tiles, bytes and times are recorded in
+       Metrics if given."""
+    opts = set_defaults(optsin)
+    metrics = metrics or Metrics()
+    processes = int(opts['processes'] or multiprocessing.cpu_count())
+    if tiles is None:
+        image_files = scandir(indir)
+    else:
+        image_files = tile_files(indir, tiles)
+    image_files = [f for f in image_files if
+                   os.path.splitext(f)[1] not in ('.notile', '.timeout')]
     numfiles = len(image_files)
-    print('Launching compression of {} image files'.format(numfiles))
-    print('We would love to tell you how long this will take, but we cannot')
-    for image_file in image_files:
-        (image_filename, image_ext) = os.path.splitext(image_file)
-        if(image_ext != '.notile' and image_ext != '.timeout'):
-            try:
-                im = Image.open(image_file)
-                im.convert('YCbCr').save(image_filename + '.jpeg', 'JPEG', quality=70)
-                os.remove(image_file)
-            except:
-                print('{} is not a valid image file.'.format(image_file))
-            
+    print('Launching compression of {} image files on {} processes'
+          .format(numfiles, processes))
+    # Chunks big enough to keep interprocess overhead down, small enough
+    # that the work still evens out between processes at the end
+    chunksize = max(1, min(64, numfiles // (processes * 8)))
+
+    with metrics.stage('compress'), Progress(metrics, 'compress', numfiles):
+        pool = multiprocessing.Pool(processes) if processes > 1 else None
+        compress = partial(compress_file, opts = opts)
+        results = (pool.imap_unordered(compress, image_files, chunksize)
+                   if pool else map(compress, image_files))
+        try:
+            for (image_file, data, imtype) in results:
+                if data is None:
+                    print('{} is not a valid image file.'.format(image_file))
+                    metrics.count('compress')
+                    continue
+                metrics.count('compress', 1, len(data))
+                if writer:
+                    (z, x, y) = path_to_zxy(os.path.splitext(image_file)[0])
+                    writer.add(z, x, y, data, imtype)
+        finally:
+            if pool:
+                pool.close()
+                pool.join()
+
 if __name__ == "__main__":
+    arguments = argumentlist()
     parser = argparse.ArgumentParser()
-    
+
     parser.add_argument("input_dir", help = "Input directory of tile files")
-    args = parser.parse_args()
-    
-    input_dir = args.input_dir  
-    
-    convert_and_compress_tiles(input_dir)
+
+    for (shortarg, longarg, actionarg, helpstring, defaultvalue) in arguments:
+        parser.add_argument('-{}'.format(shortarg), '--{}'.format(longarg),
+                            action = actionarg,  help = helpstring)
+    opts = vars(parser.parse_args())
+
+    input_dir = opts['input_dir']
+
+    convert_and_compress_tiles(input_dir, opts)
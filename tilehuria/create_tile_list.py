@@ -2,82 +2,84 @@
 """
 Create a CSV document containing a list of URLs of tiles from a Tile Map Service 
 (TMS or tileserver).
+
+generate_tile_list yields the same tiles as compact (zoom, x, y) records, for
+use by other scripts that do not need the CSV file (or the WKT outlines in it).
 """
 # Ivan Buendia Gayton, Humanitarian OpenStreetMap Team/Ramani Huria 2018
 import sys, os
 import argparse
 import csv
 import math
+import multiprocessing
 
 from utils import lat_long_zoom_to_pixel_coords
 from utils import pixel_coords_to_tile_address
 from utils import tile_coords_to_url
 from utils import tile_coords_to_quadkey
 from utils import url_template_from_file
+from utils import get_url_template
+from utils import tiles_with_urls
 
-from geo_utils import intersect
+from geo_utils import tile_block_polygon
 from geo_utils import get_ogr_driver
 from geo_utils import get_extent
 from geo_utils import get_geomcollection
 
+from tile_enumerator import tiles_in_aoi
+
 from arguments import argumentlist, set_defaults
 
+def generate_tile_list(infile, optsin = {}):
+    """Read a polygon file and yield (zoom, x, y) of every tile needed,
+       without writing anything to disk"""
+    opts = set_defaults(optsin)
+    (infilename, extension) = os.path.splitext(infile)
+    extent = get_extent(infile, extension)
+    geomcollection = get_geomcollection(infile, extension)
+    processes = int(opts['enumeration_processes']
+                    or multiprocessing.cpu_count())
+    yield from tiles_in_aoi(geomcollection, extent,
+                            opts['minzoom'], opts['maxzoom'],
+                            opts['enumeration'], processes)
+
+def write_tile_csv(tiles, outfile, url_template):
+    """Write (zoom, x, y) tile records to a CSV file of tile outlines and URLs.
+       Returns the number of tiles written."""
+    count = 0
+    with open(outfile, 'w') as csvfile:
+        writer = csv.writer(csvfile, delimiter = ';')
+        writer.writerow(['wkt','Tilex','TileY','TileZ','URL'])
+        for (zoom, tileX, tileY, URL) in tiles_with_urls(tiles, url_template):
+            poly = tile_block_polygon(tileX, tileY, tileX, tileY, zoom)
+            wkt_outline = '\"{}\"'.format(poly.ExportToWkt())
+            writer.writerow([wkt_outline,
+                             str(tileX), str(tileY), str(zoom), URL])
+            count += 1
+    return count
+
 def create_tile_list(infile, optsin = {}):
     """Read a polygon file and create a set of output files to create tiles"""
-    #print('\nThe opts received by create_tile_list are:{}'.format(type(optsin)))
-    #print('\nThe opts received by create_tile_list are:\n{}\n'.format(optsin)) 
     opts = set_defaults(optsin)
-    url_template = (opts['url_template'] if opts['url_template']
-                    else url_template_from_file(opts['tileserver']))
-    #print(url_template)
-    #print('\nThe opts returned by set_defaults are:{}'.format(type(opts)))
-    #print('\nThe opts returned by set_defaults are:\n{}\n'.format(opts))
+    url_template = get_url_template(opts)
 
     (infilename, extension) = os.path.splitext(infile)
     minzoom = opts['minzoom']
     maxzoom = opts['maxzoom']
     tileserver = opts['tileserver'] if opts['tileserver'] else 'from_url'
-    yreverse = opts['y-reverse']
 
     # Create the main output file which will contain the URL list
     outfile = '{}_{}.csv'.format(infilename, tileserver)
     if os.path.exists(outfile):
         os.remove(outfile)
-    writer = csv.writer(open(outfile, 'w'), delimiter = ';')
-    writer.writerow(['wkt','Tilex','TileY','TileZ','URL'])
-
-    (xmin, xmax, ymin, ymax) = get_extent(infile, extension)
-    geomcollection = get_geomcollection(infile, extension)
-    
-    for zoom in range(int(minzoom), int(maxzoom)+1):
-        
-        # get coordinate address of upper left left tile
-        pixel = lat_long_zoom_to_pixel_coords(ymax, xmin, zoom)
-        tile = pixel_coords_to_tile_address(pixel[0], pixel[1])
-        tileX_left = tile[0]
-        tileY_top = tile[1]
-        
-        # get coordinate address of lower right tile
-        pixel = lat_long_zoom_to_pixel_coords(ymin, xmax, zoom)
-        tile = pixel_coords_to_tile_address(pixel[0], pixel[1])    
-        tileX_right = tile[0]
-        tileY_bottom = tile[1]
-
-        for tileY in range(tileY_top, tileY_bottom + 1):
-            for tileX in range(tileX_left, tileX_right + 1):
-                inter = intersect(tileX, tileY, zoom, geomcollection)
-                if inter:
-                    wkt_outline = '\"{}\"'.format(inter)
-                    URL = tile_coords_to_url(int(tileX), int(tileY),
-                                             int(zoom), url_template)    
-                    writer.writerow([wkt_outline,
-                                     str(tileX), str(tileY), str(zoom), URL])
+    write_tile_csv(generate_tile_list(infile, opts), outfile, url_template)
 
     print('\nInput file: ' + infile)
     print('Zoom levels: {} to {}'.format(str(minzoom), str(maxzoom)))
     print('Output files:\n{}\n'
           .format(outfile))
     print()
+    return outfile
 
 if __name__ == "__main__":
 
@@ -17,148 +17,230 @@ import os
 import threading
 import csv
 import time
-import urllib.request
 import argparse
+from functools import partial
 
+from http_pool import TileResponse
+from http_pool import get_fetcher, retryable, describe_failure
+from async_download import download_tiles_async
+from work_queue import TileQueue, attempt_timeout, store_or_stop
+from work_queue import new_worker_stats, report_worker_stats
+from tileservers import get_tileserver, guess_imtype
+from blank_tiles import get_blank_detector
+from tile_cache import get_tile_cache
+from rate_limit import get_rate_limiter
+from metrics import Metrics, Progress
+from utils import compile_url_template
 from arguments import argumentlist, set_defaults
 
 def check_dir(path):
-    """If a directory does not exist, create it. Not thread-safe!"""
-    if not os.path.exists(path):
-        outdir = os.makedirs(path)
+    """If a directory does not exist, create it"""
+    os.makedirs(path, exist_ok = True)
 
 def parse_url_for_imtype(url):
-    imtype = 'png'
-    if('.jpeg' in url or '.jpg' in url):
-        imtype = 'jpg'
-    if('google' in url):  # Yes, a crude and brittle hack
-        imtype = 'jpg' 
-    return imtype
-
-def get_list_of_timeouts(dirpath):
-    """Create a list of URLs of all of tiles that timed out the first time"""
-    urllist = []
-    for path, dirs, files in os.walk(dirpath):
-        for f in files:
-            (infilename, extension) = os.path.splitext(f)
-            if extension == '.timeout':
-                url = None
-                try:
-                    infile = os.path.join(path, f)
-                    urlfile = open(infile)
-                    url = urlfile.read()
-                except:
-                    print('{} did not work'.format(urlfile))
-                urllist.append(url)
-    return urllist
-
-def managechunk(chunk, outdirpath, timeout):
-    """Downloads all tiles contained in a chunk (sub-list of tile rows)"""
-
-    chunkfailedlines = []
-    for item in chunk:
-        row = item[0].split(';')
-        url = (row[4])
-        (z, x, y) = (str(row[3]), str(row[1]), str(row[2]))
-
-        timeoutfile = os.path.join(outdirpath, z, x, '{}.timeout'.format(y))
-        notilefile = os.path.join(outdirpath, z, x, '{}.notile'.format(y))
-        rawdata = None
+    return guess_imtype(url)
+
+def tile_imtype(server, url):
+    """The image type of a tile: as given for its server, if the URL is one
+       of the server's, or else guessed from the tile's URL"""
+    if server and compile_url_template(server.url_template).matches(url):
+        return server.imtype
+    return parse_url_for_imtype(url)
+
+def read_tile_csv(csvinfile):
+    """Yield (zoom, x, y, url) for each tile in a CSV file made by
+       create_tile_list, reading one line at a time"""
+    with open(csvinfile) as csvfile:
+        reader = csv.reader(csvfile, delimiter = ';')
+        for row in reader:
+            # Skip the header and empty rows (Windows line endings)
+            if len(row) < 5 or row[1] == 'Tilex':
+                continue
+            yield (row[3], row[1], row[2], row[4])
+
+def store_tile(outdirpath, server, blank, z, x, y, url, rawdata,
+               headers = None):
+    """Write a downloaded tile into the Slippy Map folder, unless it is a
+       placeholder for no tile here. Returns 'done' or 'empty'.
+       server is the TileServer the tile came from, or None if unknown;
+       blank is a BlankDetector."""
+    if rawdata is None or blank.is_blank(rawdata):
+        return 'empty'
+    (z, x, y) = (str(z), str(x), str(y))
+    check_dir(os.path.join(outdirpath, z, x))
+    imtype = tile_imtype(server, url)
+    outfilename = os.path.join(outdirpath, z, x, '{}.{}'.format(y,imtype))
+    with open(outfilename, 'wb') as outfile:
+        outfile.write(rawdata)
+    return 'done'
+
+def worker(tilequeue, store, fetch, stats, cache = None, limiter = None,
+           validators = None):
+    """Downloads tiles from the shared queue until there are none left,
+       looking in the TileCache first if one is given, and waiting for
+       its turn from the RateLimiter if one is given. With TileValidators,
+       only tiles which have changed are downloaded again."""
+    while True:
+        item = tilequeue.get()
+        if item is None:
+            break
+        ((z, x, y, url), attempt) = item
+        (reason, retry, state) = (None, True, None)
         try:
-            rawdata = urllib.request.urlopen(url, timeout=int(timeout)).read()
-        except:
-            # Download failed. Create a timeout file as a placeholder
-            with open(timeoutfile, 'w') as outfile:
-                writer = csv.writer(outfile, delimiter = ';')
-                writer.writerow([row[0], x, y, z, url])
-                
-        if(rawdata):
-            imtype = parse_url_for_imtype(url)
-            if os.path.exists(timeoutfile):
-                os.remove(timeoutfile)
-            outfilename = os.path.join(outdirpath, z, x, '{}.{}'.format(y,imtype))
-            
-            # if the file is less than 2500 bytes, there's no tile here.
-            # Most tileservers have a blank tile less than 1kb, but the blank
-            # ESRI tile is 2.4kb, so raised this to 2600b to be sure
-            if(len(rawdata) > 2600):
-                with open(outfilename, 'wb') as outfile:
-                    outfile.write(rawdata)
+            cached = cache.get(z, x, y, url) if cache else None
+            if cached and cached.fresh:
+                response = TileResponse(200, {}, cached.data)
+            else:
+                source = limiter.wait(z, x, y, url) if limiter else url
+                headers = cache.validators(cached) if cache else {}
+                if validators:
+                    headers.update(validators.headers(z, x, y))
+                response = fetch(source, attempt_timeout(attempt), headers)
+                if limiter:
+                    limiter.feedback(source, response)
+                stats['bytes'] += len(response.data)
+                if cache:
+                    response = cache.update(z, x, y, url, cached, response)
+            if response.status == 200:
+                state = store_or_stop(tilequeue, store, z, x, y, url,
+                                      response)
+            elif response.status == 304:
+                state = 'unchanged'
+            elif response.status == 404:
+                # The server has no tile at this address
+                state = store_or_stop(tilequeue, store, z, x, y, url, None)
             else:
-                with open(notilefile, 'w') as outfile:
-                    writer = csv.writer(outfile, delimiter = ';')
-                    writer.writerow([row[0], x, y, z, url])            
-
-def task(inlist, num_threads, outdirpath, timeout):
-    # Filter out empty rows to manage Windows line ending character encoding
-    list_of_rows = [row for row in inlist if row]
-    header_row = list_of_rows.pop(0)
-    # Break the list into chunks of approximately equal size
-    chunks = [list_of_rows[i::num_threads] for i in range(num_threads)]
-
-    # Create Slippy Map-type folder structure (before tasking for thread safety)
-    for line in list_of_rows:
-        row = line[0].split(';')
-        (z, x) = (str(row[3]), str(row[1]), )
-        check_dir('{}{}/{}'.format(outdirpath, z, x))
+                reason = 'HTTP {}'.format(response.status)
+                retry = retryable(response.status)
+        except Exception as e:
+            reason = describe_failure(e)
+        if reason:
+            stats['errors'] += 1
+        stats['tiles'] += 1
+        tilequeue.done((z, x, y, url), attempt, reason, retry, state)
+    stats['finished'] = time.time()
+
+def task(tilequeue, num_threads, store, fetch, cache = None,
+         limiter = None, validators = None):
+    """Download tiles using a number of threads pulling from a shared queue.
+       Returns a list of per-thread statistics."""
+    all_stats = [new_worker_stats('thread {}'.format(i))
+                 for i in range(num_threads)]
 
     threads = []
 
-    for chunk in chunks:
-        thread = threading.Thread(target=managechunk,
-                                  args=(chunk, outdirpath, timeout))
+    for stats in all_stats:
+        thread = threading.Thread(target=worker,
+                                  args=(tilequeue, store, fetch, stats,
+                                        cache, limiter, validators))
         threads.append(thread)
         thread.start()
 
     for thread in threads:
         thread.join()
+    return all_stats
 
-def download_all_tiles_in_csv(csvinfile, optsin = {}):
-    """Eat CSV of tile urls, spit out folder full of tiles"""
-    (infilename, extension) = os.path.splitext(csvinfile)
-    outdirpath = os.path.join(infilename, '')
-    check_dir(outdirpath)
+def write_failed_csv(failures, failedcsv):
+    """Write tiles which could not be downloaded, and why, to a CSV file
+       which can itself be given to download_all_tiles_in_csv"""
+    with open(failedcsv, 'w') as csvfile:
+        writer = csv.writer(csvfile, delimiter = ';')
+        writer.writerow(['wkt','Tilex','TileY','TileZ','URL','reason'])
+        for ((z, x, y, url), reason) in sorted(failures.items()):
+            writer.writerow(['', x, y, z, url, reason])
+
+def download_tiles(tiles, outdirpath, optsin = {}, journal = None,
+                   store = None, validators = None, metrics = None,
+                   total = None):
+    """Download an iterable of (zoom, x, y, url) tile records into a
+       Slippy Map-style folder, recording the outcomes in a TileJournal
+       if one is given. To put the tiles somewhere else, give a function
+       store(z, x, y, url, rawdata, headers) returning 'done' or 'empty'
+       (or 'queued', if it records the tile in the journal itself); rawdata
+       is None if the server has no tile there.
+       With TileValidators, requests are conditional on the tiles having
+       changed, and those which have not are marked 'unchanged'.
+       Requests and timings are recorded in Metrics if given; total is the
+       number of tiles, if known, to estimate the time left."""
+    opts = set_defaults(optsin)
+    outdirpath = os.path.join(outdirpath, '')
+    metrics = metrics or Metrics()
+    blank = None
+    server = get_tileserver(opts)
+    cache = get_tile_cache(opts, server)
+    limiter = get_rate_limiter(opts, server)
+    if store is None:
+        check_dir(outdirpath)
+        blank = get_blank_detector(opts, server)
+        store = partial(store_tile, outdirpath, server, blank)
     threads_to_use=50
-    
+
     start = time.time()
-    with open(csvinfile) as csvfile:
-        reader = csv.reader(csvfile)
-        tile_rows = list(reader)
-        if(len(tile_rows)) < 100:
-           threads_to_use = int(len(tile_rows)/2)
-        print('Starting download of {} tiles'.format(len(tile_rows)))
-        task(tile_rows, threads_to_use, outdirpath, 10)
+    # Compact tuples, taken from the iterable as the workers need them
+    tilequeue = TileQueue((tuple(tile) for tile in tiles),
+                          int(opts['max_attempts']), journal = journal)
+    print('Starting download')
+    progress = Progress(metrics, 'download', total,
+                        lambda: tilequeue.succeeded + len(tilequeue.failures))
+    with metrics.stage('download'), progress:
+        if opts['downloader'] == 'async':
+            download_tiles_async(tilequeue, store, opts, cache, limiter,
+                                 validators, metrics)
+        else:
+            (fetch, pool) = get_fetcher(opts, metrics)
+            all_stats = task(tilequeue, threads_to_use, store, fetch, cache,
+                             limiter, validators)
+    metrics.count('download', tilequeue.total)
+    if opts['downloader'] != 'async':
+        report_worker_stats(all_stats, opts['verbose'])
+        if pool:
+            if opts['verbose']:
+                print('{} requests used {} connections'
+                      .format(pool.requests, pool.opened))
+            pool.close()
 
+    if journal:
+        journal.flush()
     end = time.time() - start
-    print('Finished. Downloading took {} seconds'.format(end))
-
-    # Check number of timeouts
-    tile_timeouts = get_list_of_timeouts(outdirpath)
-    if len(tile_timeouts):
-        print('{} tiles failed to download due to timeout'
-              .format(len(tile_timeouts)))
-        
-        print('Trying timed-out tiles again, with half the number of threads '
-              'and a 100-second timeout')
-        threads_to_use = 25
-        if(len(tile_rows)) < 100:
-            threads_to_use = int(len(tile_rows)/4)
-        task(tile_rows, threads_to_use, outdirpath, 100)
-    
-        tile_timeouts = get_list_of_timeouts(outdirpath)
-        if len(tile_timeouts):
-            print('{} tiles failed to download a second time due to timeout'
-                  .format(len(tile_timeouts)))
-            timeoutcsv = '{}_timeouts.csv'.format(infilename)
-            with open(timeoutcsv, 'w') as to:
-               to.write('wkt;Tilex;TileY;TileZ;URL\n')
-               for line in tile_timeouts:
-                   to.write(line)
-            print('See:\n{} \nfor list of failed/missing tiles'.format(timeoutcsv))
-        else:
-            print('Looks like all tiles were downloaded on the second and last try!')
+    print('Finished. Downloading {} tiles took {} seconds'
+          .format(tilequeue.total, end))
+    if opts['verbose']:
+        metrics.print_hosts()
+    if cache and (cache.hits or cache.revalidated):
+        print('{} tiles came from the cache, and {} more were checked with '
+              'the server and had not changed'
+              .format(cache.hits, cache.revalidated))
+    if limiter.throttled or (limiter.waited and opts['verbose']):
+        print('Servers asked us to slow down {} times; downloads waited {:.1f} '
+              'seconds in all for their turn'
+              .format(limiter.throttled, limiter.waited))
+    if cache:
+        cache.evict()
+        cache.close()
+    if tilequeue.empty:
+        print('{} tiles had no imagery'.format(tilequeue.empty))
+        if blank and opts['verbose']:
+            blank.report()
+    if tilequeue.retried:
+        print('{} downloads failed and were tried again'
+              .format(tilequeue.retried))
+
+    if tilequeue.stopped:
+        print('The download was stopped: {}'.format(tilequeue.stopped))
+    if tilequeue.failures:
+        print('{} tiles could not be downloaded in {} attempts'
+              .format(len(tilequeue.failures), tilequeue.max_attempts))
+        failedcsv = '{}_failed.csv'.format(outdirpath.rstrip(os.sep))
+        write_failed_csv(tilequeue.failures, failedcsv)
+        print('See:\n{} \nfor list of failed/missing tiles'.format(failedcsv))
     else:
-        print('Looks like all tiles were downloaded on the first try!')
+        print('Looks like all tiles were downloaded!')
+    return tilequeue
+
+def download_all_tiles_in_csv(csvinfile, optsin = {}):
+    """Eat CSV of tile urls, spit out folder full of tiles"""
+    (infilename, extension) = os.path.splitext(csvinfile)
+    download_tiles(read_tile_csv(csvinfile), infilename, optsin)
 
 if __name__ == "__main__":
 
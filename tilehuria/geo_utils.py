@@ -102,6 +102,36 @@ def intersect(tileX, tileY, zoom, geomcollection):
     intersect = geomcollection.Intersect(poly)
     return poly.ExportToWkt() if intersect else None
 
+def tile_block_polygon(tileX_left, tileY_top, tileX_right, tileY_bottom, zoom):
+    """Returns an OGR polygon of the outline of a rectangular block of tiles.
+       For a single tile this is exactly the polygon made by intersect()."""
+    (latt, lonl) = lat_long_upper_left(tileX_left, tileY_top, zoom)
+    (latb, lonr) = lat_long_lower_right(tileX_right, tileY_bottom, zoom)
+
+    ring = ogr.Geometry(ogr.wkbLinearRing)
+    points = [(lonl, latt), (lonr, latt), (lonr, latb), (lonl, latb), (lonl, latt)]
+    for point in points:
+        ring.AddPoint(point[0], point[1])
+    poly = ogr.Geometry(ogr.wkbPolygon)
+    poly.AddGeometry(ring)
+    return poly
+
+def get_union(geomcollection):
+    """Dissolve a geometry collection into a single geometry.
+       GEOS refuses containment tests on geometry collections, so tests
+       for tiles entirely inside the Area of Interest use this instead.
+       Returns None if the geometries cannot be dissolved."""
+    union = None
+    try:
+        for i in range(geomcollection.GetGeometryCount()):
+            geom = geomcollection.GetGeometryRef(i)
+            union = geom.Clone() if union is None else union.Union(geom)
+    except Exception as e:
+        print('Could not dissolve the Area of Interest geometries')
+        print(e)
+        return None
+    return union
+
 def create_poly_if_intersect(tileX, tileY, zoom, geomcollection):
     """Checks if a given tile intersects with a polygon geometry collection.
        Returns an OGR polygon object of tile perimeter."""
@@ -0,0 +1,178 @@
+#!/usr/bin/python3
+"""
+HTTP backends for downloading tiles.
+
+urllib: a new connection (and TLS handshake) for every tile, as urllib does.
+pooled: a bounded pool of persistent HTTP/1.1 keep-alive connections per
+        tile host, shared by all download threads.
+
+Both return a TileResponse of (status, headers, data) rather than raising on
+HTTP error codes, so the downloader can tell a missing tile from a timeout.
+Network errors and timeouts are still raised.
+"""
+import sys, os
+import socket
+import threading
+import time
+import queue
+import http.client
+import urllib.request
+import urllib.error
+from urllib.parse import urlsplit
+from collections import namedtuple
+
+TileResponse = namedtuple('TileResponse', ['status', 'headers', 'data'])
+
+USER_AGENT = 'tilehuria/0.1.1'
+
+DOWNLOADERS = ('urllib', 'pooled', 'async')
+
+def retryable(status):
+    """True if an HTTP error status is worth trying again later"""
+    return status in (408, 429) or status >= 500
+
+def header(headers, name):
+    """A response header, whatever its capitalisation, or None"""
+    name = name.lower()
+    for (key, value) in (headers or {}).items():
+        if key.lower() == name:
+            return value
+    return None
+
+def describe_failure(e):
+    """A short reason for a failed download, from the exception raised"""
+    reason = getattr(e, 'reason', e)  # urllib wraps socket errors
+    if isinstance(reason, (socket.timeout, TimeoutError)):
+        return 'timeout'
+    return '{}: {}'.format(type(reason).__name__, reason)
+
+def urllib_fetch(url, timeout, headers = None):
+    """Download a URL on a new connection, return a TileResponse"""
+    request = urllib.request.Request(url, headers = headers or {})
+    try:
+        with urllib.request.urlopen(request, timeout = timeout) as response:
+            return TileResponse(response.status, dict(response.headers),
+                                response.read())
+    except urllib.error.HTTPError as e:
+        return TileResponse(e.code, dict(e.headers or {}), b'')
+
+class ConnectionPool:
+    """Persistent keep-alive connections, at most max_per_host per host.
+       Threads wanting a connection to a host which has max_per_host
+       connections busy wait for one to be returned to the pool. Every
+       request is recorded in Metrics if given, timed from when it has a
+       connection."""
+
+    def __init__(self, max_per_host = 8, metrics = None):
+        self.max_per_host = max(1, int(max_per_host))
+        self.metrics = metrics
+        self.lock = threading.Lock()
+        self.idle = {}        # (scheme, host, port): queue of idle connections
+        self.slots = {}       # (scheme, host, port): semaphore of connections
+        self.opened = 0       # connections opened, to compare against requests
+        self.requests = 0
+
+    def _host_state(self, key):
+        with self.lock:
+            if key not in self.slots:
+                self.slots[key] = threading.BoundedSemaphore(self.max_per_host)
+                self.idle[key] = queue.LifoQueue()
+            return (self.slots[key], self.idle[key])
+
+    def _new_connection(self, key, timeout):
+        (scheme, host, port) = key
+        with self.lock:
+            self.opened += 1
+        if scheme == 'https':
+            return http.client.HTTPSConnection(host, port, timeout = timeout)
+        return http.client.HTTPConnection(host, port, timeout = timeout)
+
+    def fetch(self, url, timeout, headers = None):
+        """Download a URL on a pooled connection, return a TileResponse"""
+        parts = urlsplit(url)
+        key = (parts.scheme, parts.hostname, parts.port)
+        path = parts.path or '/'
+        if parts.query:
+            path = '{}?{}'.format(path, parts.query)
+        request_headers = {'User-Agent': USER_AGENT,
+                           'Connection': 'keep-alive'}
+        request_headers.update(headers or {})
+
+        (slots, idle) = self._host_state(key)
+        queued = time.monotonic()
+        with slots:
+            with self.lock:
+                self.requests += 1
+            (start, cpu) = (time.monotonic(), time.thread_time())
+            try:
+                response = self._request(key, idle, path, request_headers,
+                                         timeout)
+            except Exception as e:
+                if self.metrics:
+                    self.metrics.fetched(url, time.monotonic() - start,
+                                         error = e,
+                                         cpu = time.thread_time() - cpu,
+                                         wait = start - queued)
+                raise
+            if self.metrics:
+                self.metrics.fetched(url, time.monotonic() - start, response,
+                                     cpu = time.thread_time() - cpu,
+                                     wait = start - queued)
+            return response
+
+    def _request(self, key, idle, path, request_headers, timeout):
+        """Make a request on an idle connection to a host, or a new one"""
+        # A reused connection may have been closed by the server while
+        # idle; in that case try once more on a fresh connection
+        for attempt in range(2):
+            try:
+                conn = idle.get_nowait()
+                reused = True
+            except queue.Empty:
+                conn = self._new_connection(key, timeout)
+                reused = False
+            conn.timeout = timeout
+            if conn.sock:
+                conn.sock.settimeout(timeout)
+            try:
+                conn.request('GET', path, headers = request_headers)
+                response = conn.getresponse()
+                data = response.read()
+            except (http.client.RemoteDisconnected,
+                    http.client.BadStatusLine,
+                    ConnectionResetError, BrokenPipeError):
+                conn.close()
+                if reused:
+                    continue
+                raise
+            except Exception:
+                conn.close()
+                raise
+            if response.will_close:
+                conn.close()
+            else:
+                idle.put(conn)
+            return TileResponse(response.status,
+                                dict(response.getheaders()), data)
+        raise ConnectionError('Could not get a connection to {}'
+                              .format(key[1]))
+
+    def close(self):
+        """Close all idle connections"""
+        with self.lock:
+            for idle in self.idle.values():
+                while not idle.empty():
+                    idle.get_nowait().close()
+
+def get_fetcher(opts, metrics = None):
+    """Returns (fetch function, pool or None) for the downloader in opts,
+       recording its requests in Metrics if given"""
+    downloader = opts.get('downloader') or 'pooled'
+    if downloader == 'urllib':
+        return (metrics.measured(urllib_fetch) if metrics else urllib_fetch,
+                None)
+    if downloader != 'pooled':
+        print('Unknown downloader {}, using pooled connections'
+              .format(downloader))
+    pool = ConnectionPool(int(opts.get('connections') or 8), metrics)
+    return (pool.fetch, pool)
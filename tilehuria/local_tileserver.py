@@ -0,0 +1,166 @@
+#!/usr/bin/python3
+"""
+A local stand-in tileserver for testing and benchmarking the downloader
+without hammering a real tileserver.
+
+Serves made-up tiles at http://127.0.0.1:<port>/{z}/{x}/{y}.png using
+HTTP/1.1 keep-alive, optionally waiting a while before each response to
+imitate the latency of a real server.
+
+To imitate the rest of a real server's behaviour, a share of requests can
+fail with 503 Service Unavailable (error_rate), and a share of tiles can be
+a "no imagery here" placeholder (blank_ratio). Which requests fail and
+which tiles are blank depend only on the tile (and how many times it has
+been asked for), so every run sees the same ones. The tiles can be real
+JPEG images (images), for compression to work on, rather than made-up
+bytes.
+
+Example:
+    python3 local_tileserver.py -p 8080 -l 0.05 -e 0.01 -b 0.2
+"""
+import sys, os
+import argparse
+import hashlib
+import re
+import threading
+import time
+import io
+import functools
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+from PIL import Image
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+NUM_IMAGES = 32   # different real images to serve
+
+def make_tile(z, x, y, size):
+    """Made-up tile content of a given size, different for every tile"""
+    seed = hashlib.sha1('{}/{}/{}'.format(z, x, y).encode()).digest()
+    body = seed * (size // len(seed) + 1)
+    return (PNG_SIGNATURE + body)[:size]
+
+def fraction(*key):
+    """A number from 0 to 1, always the same for the same key"""
+    digest = hashlib.sha1('/'.join(str(k) for k in key).encode()).digest()
+    return int.from_bytes(digest[:8], 'big') / 2.0 ** 64
+
+@functools.lru_cache(maxsize = None)
+def blank_tile():
+    """A plain white 256x256 PNG placeholder tile"""
+    f = io.BytesIO()
+    Image.new('RGB', (256, 256), (255, 255, 255)).save(f, 'PNG')
+    return f.getvalue()
+
+@functools.lru_cache(maxsize = None)
+def image_tiles():
+    """NUM_IMAGES different 256x256 JPEG images, noisy enough to be about
+       the size of aerial imagery tiles"""
+    rng = np.random.default_rng(0)
+    images = []
+    for i in range(NUM_IMAGES):
+        base = rng.integers(0, 256, (16, 16, 3), dtype = np.uint8)
+        im = Image.fromarray(base).resize((256, 256), Image.BILINEAR)
+        noise = rng.integers(-24, 24, (256, 256, 3))
+        pixels = np.clip(np.asarray(im, dtype = np.int16) + noise, 0, 255)
+        f = io.BytesIO()
+        Image.fromarray(pixels.astype(np.uint8)).save(f, 'JPEG', quality = 90)
+        images.append(f.getvalue())
+    return images
+
+def make_image_tile(z, x, y):
+    """A real JPEG tile, one of NUM_IMAGES chosen by the tile"""
+    images = image_tiles()
+    return images[int(fraction('image', z, x, y) * len(images))]
+
+class TileHandler(BaseHTTPRequestHandler):
+    """Answers GET /z/x/y.ext with a made-up tile"""
+    protocol_version = 'HTTP/1.1'
+    # Headers and body go out in separate writes; without this, Nagle's
+    # algorithm stalls every keep-alive response waiting for a delayed ACK
+    disable_nagle_algorithm = True
+    tilepath = re.compile(r'^/(\d+)/(\d+)/(\d+)\.\w+$')
+
+    def do_GET(self):
+        match = self.tilepath.match(self.path)
+        if not match:
+            self.send_error(404)
+            return
+        (z, x, y) = match.groups()
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        if self.server.error_rate and self.failed():
+            self.send_response(503)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        if fraction('blank', z, x, y) < self.server.blank_ratio:
+            (data, content_type) = (blank_tile(), 'image/png')
+        elif self.server.images:
+            (data, content_type) = (make_image_tile(z, x, y), 'image/jpeg')
+        else:
+            (data, content_type) = (make_tile(z, x, y, self.server.tile_size),
+                                    'image/png')
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def failed(self):
+        """True if this request should fail: a share of the first requests
+           for each tile, a share of those again for the second, and so on"""
+        with self.server.lock:
+            attempt = self.server.attempts.get(self.path, 0) + 1
+            self.server.attempts[self.path] = attempt
+        return fraction('error', self.path, attempt) < self.server.error_rate
+
+    def log_message(self, format, *args):
+        """Keep quiet; a benchmark makes thousands of requests"""
+        pass
+
+def start_tileserver(port = 0, latency = 0.0, tile_size = 10000,
+                     error_rate = 0.0, blank_ratio = 0.0, images = False):
+    """Start a tileserver in a background thread.
+       Returns the server (call shutdown() on it to stop) and its URL template.
+       Port 0 picks any free port."""
+    server = ThreadingHTTPServer(('127.0.0.1', int(port)), TileHandler)
+    server.daemon_threads = True
+    server.latency = float(latency)
+    server.tile_size = int(tile_size)
+    server.error_rate = float(error_rate)
+    server.blank_ratio = float(blank_ratio)
+    server.images = bool(images)
+    server.attempts = {}   # path: number of requests for it
+    server.lock = threading.Lock()
+    thread = threading.Thread(target = server.serve_forever, daemon = True)
+    thread.start()
+    url_template = 'http://127.0.0.1:{}/{{z}}/{{x}}/{{y}}.png'.format(
+        server.server_address[1])
+    return (server, url_template)
+
+if __name__ == "__main__":
+    p = argparse.ArgumentParser()
+    p.add_argument('-p', '--port', help = 'Port to listen on', default = 8080)
+    p.add_argument('-l', '--latency', default = 0.0,
+                   help = 'Seconds to wait before answering each request')
+    p.add_argument('-s', '--tile_size', default = 10000,
+                   help = 'Size of each tile in bytes')
+    p.add_argument('-e', '--error_rate', default = 0.0,
+                   help = 'Share of requests to answer with HTTP 503')
+    p.add_argument('-b', '--blank_ratio', default = 0.0,
+                   help = 'Share of tiles which are blank placeholders')
+    p.add_argument('-i', '--images', action = 'store_true',
+                   help = 'Serve real JPEG images rather than made-up bytes')
+    opts = vars(p.parse_args())
+    (server, url_template) = start_tileserver(opts['port'], opts['latency'],
+                                              opts['tile_size'],
+                                              opts['error_rate'],
+                                              opts['blank_ratio'],
+                                              opts['images'])
+    print('Serving tiles at {}'.format(url_template))
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -0,0 +1,309 @@
+#!/usr/bin/python3
+"""
+Measurements of each stage of making an MBTiles file, to size jobs and to
+spot slow mirror servers.
+
+For every stage (enumerate, download, compress, write): the wall clock and
+CPU time it took, and the tiles and bytes that went through it. For every
+tile host: the number of requests, the bytes they brought, and the 50th,
+95th and 99th percentile of how long they took, timed by the connection
+pools from when a connection to the host was free, so that they measure
+the host rather than the queue for its connections. How long requests
+waited for a connection is given separately. Failed downloads are
+counted by what went wrong (timeout, HTTP 503 and so on).
+
+While a stage runs, a progress line shows how far it has got, how fast it
+is going, and (where the number of tiles is known) how long it has to go.
+At the end everything can be written to a JSON report.
+"""
+import sys, os
+import json
+import asyncio
+import threading
+import time
+from array import array
+from contextlib import contextmanager
+from urllib.parse import urlsplit
+
+import numpy as np
+
+from http_pool import describe_failure
+
+def thread_cpu_time():
+    """CPU seconds used by the current thread, and by the finished child
+       processes of this process (such as the compression pool)"""
+    t = os.times()
+    return time.thread_time() + t.children_user + t.children_system
+
+def error_type(reason):
+    """The kind of failure from a reason such as 'ConnectionResetError:
+       [Errno 104] ...', 'timeout' or 'HTTP 503'"""
+    return reason.split(':')[0]
+
+def response_error(response):
+    """What went wrong with a response, or None if it is a tile (or a
+       tile that has not changed)"""
+    if response.status in (200, 304):
+        return None
+    return 'HTTP {}'.format(response.status)
+
+def format_duration(seconds):
+    (minutes, seconds) = divmod(int(seconds), 60)
+    (hours, minutes) = divmod(minutes, 60)
+    return '{}:{:02d}:{:02d}'.format(hours, minutes, seconds)
+
+class Metrics:
+    """Counters and timings for one run. Safe to share between threads.
+
+       CPU time is counted per thread, so that work going on at the same
+       time in other threads (compressing and writing tiles while they are
+       downloaded, say) is only counted in the stage it belongs to."""
+
+    def __init__(self):
+        self.started = time.time()
+        self.stages = {}     # name: {wall, cpu, tiles, bytes, started}
+        self.latencies = {}  # host: array of seconds per request
+        self.waits = {}      # host: array of seconds waiting to be sent
+        self.host_bytes = {}
+        self.errors = {}     # error type: number of failed requests
+        self.attributed = {} # thread: CPU seconds timed for a stage
+        self.lock = threading.Lock()
+
+    def _stage(self, name):
+        if name not in self.stages:
+            self.stages[name] = {'wall': 0.0, 'cpu': 0.0, 'tiles': 0,
+                                 'bytes': 0, 'started': None}
+        return self.stages[name]
+
+    def _attribute(self, record, cpu):
+        """Add CPU time of the current thread to a stage's record"""
+        record['cpu'] += cpu
+        thread = threading.get_ident()
+        self.attributed[thread] = self.attributed.get(thread, 0.0) + cpu
+
+    @contextmanager
+    def stage(self, name):
+        """Time a whole stage of the pipeline: wall clock time, and the CPU
+           time of this thread and any worker processes it waits for, less
+           any of it timed for another stage. Work done by other threads
+           is added with timer(), or by fetched() for downloads."""
+        thread = threading.get_ident()
+        with self.lock:
+            record = self._stage(name)
+            record['started'] = record['started'] or time.time()
+            attributed = self.attributed.get(thread, 0.0)
+        (wall, cpu) = (time.monotonic(), thread_cpu_time())
+        try:
+            yield record
+        finally:
+            cpu = thread_cpu_time() - cpu
+            with self.lock:
+                record['wall'] += time.monotonic() - wall
+                record['cpu'] += cpu - (self.attributed.get(thread, 0.0)
+                                        - attributed)
+
+    @contextmanager
+    def timer(self, name, wall = False):
+        """Add the CPU time of a piece of work on the current thread to a
+           stage, for work (like compressing tiles as they are downloaded)
+           done in the middle of another stage. With wall, add its wall
+           clock time too, for a stage done by a single thread of its own
+           (like writing the tiles)."""
+        (start, cpu) = (time.monotonic(), time.thread_time())
+        try:
+            yield
+        finally:
+            with self.lock:
+                record = self._stage(name)
+                self._attribute(record, time.thread_time() - cpu)
+                if wall:
+                    record['wall'] += time.monotonic() - start
+
+    def timed(self, name, tiles):
+        """Pass on an iterable of tiles, counting them and adding the time
+           taken to produce them to a stage"""
+        iterator = iter(tiles)
+        while True:
+            (wall, cpu) = (time.monotonic(), time.thread_time())
+            tile = next(iterator, None)
+            with self.lock:
+                record = self._stage(name)
+                record['started'] = record['started'] or time.time()
+                record['wall'] += time.monotonic() - wall
+                self._attribute(record, time.thread_time() - cpu)
+                if tile is not None:
+                    record['tiles'] += 1
+            if tile is None:
+                return
+            yield tile
+
+    def count(self, name, tiles = 1, nbytes = 0):
+        """Count tiles (and their bytes) through a stage"""
+        with self.lock:
+            record = self._stage(name)
+            record['tiles'] += tiles
+            record['bytes'] += nbytes
+
+    def request(self, url, latency, nbytes = 0, reason = None, cpu = 0.0,
+                wait = 0.0):
+        """Record a request to a tile host: how long it took, how many
+           bytes it brought, and what went wrong, if anything. cpu is the
+           CPU time the download thread spent on it, and wait how long it
+           waited for a connection before it was sent."""
+        host = urlsplit(url).netloc
+        with self.lock:
+            if host not in self.latencies:
+                self.latencies[host] = array('d')
+                self.waits[host] = array('d')
+                self.host_bytes[host] = 0
+            self.latencies[host].append(latency)
+            self.waits[host].append(wait)
+            self.host_bytes[host] += nbytes
+            self._stage('download')['bytes'] += nbytes
+            self._stage('download')['cpu'] += cpu
+            if reason:
+                kind = error_type(reason)
+                self.errors[kind] = self.errors.get(kind, 0) + 1
+
+    def fetched(self, url, latency, response = None, error = None,
+                cpu = 0.0, wait = 0.0):
+        """Record a request made by a connection pool, which got either a
+           TileResponse or an error"""
+        if error is None:
+            self.request(url, latency, len(response.data),
+                         response_error(response), cpu, wait)
+        elif isinstance(error, asyncio.TimeoutError):
+            self.request(url, latency, 0, 'timeout', cpu, wait)
+        else:
+            self.request(url, latency, 0, describe_failure(error), cpu, wait)
+
+    def measured(self, fetch):
+        """A fetch function for download threads, which records every
+           request it makes and the CPU time the thread spends on it, for
+           fetch functions without a connection pool to do it"""
+        def measured_fetch(url, timeout, headers = None):
+            (start, cpu) = (time.monotonic(), time.thread_time())
+            try:
+                response = fetch(url, timeout, headers)
+            except Exception as e:
+                self.fetched(url, time.monotonic() - start, error = e,
+                             cpu = time.thread_time() - cpu)
+                raise
+            self.fetched(url, time.monotonic() - start, response,
+                         cpu = time.thread_time() - cpu)
+            return response
+        return measured_fetch
+
+    def progress_line(self, name, total = None, done = None):
+        """A line on how a stage is getting on. done is a function giving
+           the number of tiles done, if the stage does not count them."""
+        with self.lock:
+            record = dict(self._stage(name))
+        if done:
+            record['tiles'] = done()
+        elapsed = time.time() - (record['started'] or time.time())
+        rate = record['tiles'] / elapsed if elapsed > 0 else 0.0
+        line = '{}: {} tiles'.format(name, record['tiles'])
+        if total:
+            line += ' of {} ({:.0f}%)'.format(
+                total, 100.0 * record['tiles'] / total)
+        line += ', {:.1f} tiles/s'.format(rate)
+        if record['bytes']:
+            line += ', {:.2f} MB/s'.format(
+                record['bytes'] / elapsed / 1e6 if elapsed > 0 else 0.0)
+        if total and rate > 0:
+            line += ', about {} to go'.format(
+                format_duration(max(0, total - record['tiles']) / rate))
+        return line
+
+    def summary(self):
+        """Everything measured, as a dict ready to be written as JSON"""
+        with self.lock:
+            stages = {}
+            for (name, record) in self.stages.items():
+                wall = record['wall']
+                stages[name] = {
+                    'wall_seconds': round(wall, 3),
+                    'cpu_seconds': round(record['cpu'], 3),
+                    'tiles': record['tiles'],
+                    'bytes': record['bytes'],
+                    'tiles_per_second': (round(record['tiles'] / wall, 2)
+                                         if wall > 0 else None),
+                    'bytes_per_second': (round(record['bytes'] / wall)
+                                         if wall > 0 else None)}
+            hosts = {}
+            for (host, latencies) in self.latencies.items():
+                seconds = np.frombuffer(latencies, dtype = np.float64)
+                waits = np.frombuffer(self.waits[host], dtype = np.float64)
+                (p50, p95, p99) = np.percentile(seconds, [50, 95, 99])
+                hosts[host] = {'requests': len(seconds),
+                               'bytes': self.host_bytes[host],
+                               'latency_p50': round(float(p50), 4),
+                               'latency_p95': round(float(p95), 4),
+                               'latency_p99': round(float(p99), 4),
+                               'latency_mean': round(float(seconds.mean()),
+                                                     4),
+                               'wait_p95': round(float(
+                                   np.percentile(waits, 95)), 4),
+                               'wait_mean': round(float(waits.mean()), 4)}
+            return {'started': time.strftime('%Y-%m-%dT%H:%M:%S',
+                                             time.localtime(self.started)),
+                    'seconds': round(time.time() - self.started, 3),
+                    'stages': stages, 'hosts': hosts,
+                    'errors': dict(self.errors)}
+
+    def print_hosts(self):
+        """Print the latency of each host, slowest first, and the failed
+           requests by type"""
+        summary = self.summary()
+        hosts = summary['hosts']
+        for (host, h) in sorted(hosts.items(),
+                                key = lambda item: -item[1]['latency_p95']):
+            print('  {}: {} requests, latency p50 {:.3f}s, p95 {:.3f}s, '
+                  'p99 {:.3f}s; waited {:.3f}s for a connection on average'
+                  .format(host, h['requests'], h['latency_p50'],
+                          h['latency_p95'], h['latency_p99'], h['wait_mean']))
+        for (kind, count) in sorted(summary['errors'].items()):
+            print('  {} requests failed with {}'.format(count, kind))
+
+    def write_report(self, path, extra = {}):
+        """Write the summary, and anything else given, to a JSON file"""
+        report = self.summary()
+        report.update(extra)
+        with open(path, 'w') as f:
+            json.dump(report, f, indent = 2, sort_keys = True)
+
+class Progress:
+    """Keeps a progress line for a stage up to date from a background
+       thread, in place on a terminal, or every so often otherwise"""
+
+    def __init__(self, metrics, name, total = None, done = None,
+                 interval = None):
+        self.metrics = metrics
+        self.name = name
+        self.total = total
+        self.done = done
+        self.tty = sys.stdout.isatty()
+        self.interval = interval or (1.0 if self.tty else 10.0)
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target = self._run, daemon = True)
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            self.show()
+
+    def show(self, end = None):
+        line = self.metrics.progress_line(self.name, self.total, self.done)
+        if self.tty:
+            print('\r' + line.ljust(79), end = end or '', flush = True)
+        else:
+            print(line, flush = True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stopped.set()
+        self.thread.join()
+        self.show(end = '\n')
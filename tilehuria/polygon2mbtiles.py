@@ -5,13 +5,80 @@ Create a set of MBTiles from a Slippy Map tileserver.
 # Ivan Buendia Gayton, Humanitarian OpenStreetMap Team/Ramani Huria, 2018
 import sys, os
 import argparse
+import hashlib
+from functools import partial
 
-from create_tile_list import create_tile_list
-from download_all_tiles_in_csv import download_all_tiles_in_csv
+from create_tile_list import create_tile_list, generate_tile_list
+from download_all_tiles_in_csv import download_tiles, read_tile_csv
+from download_all_tiles_in_csv import tile_imtype
+from tileservers import get_tileserver
+from http_pool import header
+from blank_tiles import get_blank_detector
+from tile_journal import TileJournal
+from utils import get_url_template, tiles_with_urls
 from convert_and_compress_tiles import convert_and_compress_tiles
-from write_mbtiles import write_mbtiles
+from convert_and_compress_tiles import compress_tile
+from write_mbtiles import MBTilesWriter, TileValidators, missing_tiles
+from metrics import Metrics
 from arguments import argumentlist, set_defaults
 
+def store_in_mbtiles(writer, server, blank, z, x, y, url, rawdata,
+                     headers = None, metrics = None):
+    """Compress a downloaded tile and hand it to an MBTilesWriter, along
+       with its ETag and Last-Modified headers. The writer records it in
+       the journal once it is in the file. rawdata is None if the server
+       has no tile there. When adding to an existing file, a tile which
+       no longer has any imagery is taken out of it."""
+    if rawdata is None or blank.is_blank(rawdata):
+        if writer.bulk:
+            return 'empty'
+        writer.remove(z, x, y)
+        return 'queued'
+    imtype = tile_imtype(server, url)
+    metrics = metrics or Metrics()
+    try:
+        with metrics.timer('compress'):
+            (rawdata, imtype) = compress_tile(rawdata, writer.opts)
+    except Exception:
+        print('Tile {}/{}/{} is not a valid image file.'.format(z, x, y))
+    metrics.count('compress', 1, len(rawdata))
+    writer.add(z, x, y, rawdata, imtype, header(headers, 'ETag'),
+               header(headers, 'Last-Modified'))
+    return 'queued'
+
+def job_parameters(infile, opts, url_template):
+    """What a job is asked to do, to tell whether a journal is for it"""
+    with open(infile, 'rb') as f:
+        aoi = hashlib.sha1(f.read()).hexdigest()
+    return {'minzoom': int(opts['minzoom']), 'maxzoom': int(opts['maxzoom']),
+            'aoi': aoi, 'tileserver': opts['tileserver'],
+            'url_template': url_template}
+
+def write_report(metrics, reportfile, tilequeue, opts):
+    """Write the measurements of a run, with what became of the tiles and
+       the main options, to a JSON file"""
+    metrics.write_report(reportfile, {
+        'tiles': {'total': tilequeue.total,
+                  'succeeded': tilequeue.succeeded,
+                  'empty': tilequeue.empty,
+                  'unchanged': tilequeue.unchanged,
+                  'failed': len(tilequeue.failures),
+                  'retried': tilequeue.retried},
+        'options': {key: opts.get(key) for key in
+                    ('tileserver', 'minzoom', 'maxzoom', 'downloader',
+                     'direct', 'format', 'quality', 'processes')}})
+    print('The measurements of this run are in {}'.format(reportfile))
+
+def report_refresh(tilequeue, writer):
+    """Print how much of a tileset changed when it was refreshed"""
+    print('Refreshed {} tiles: {} unchanged, {} rewritten, {} no longer '
+          'with any imagery and removed, {} failed'
+          .format(tilequeue.total, tilequeue.unchanged, writer.count,
+                  writer.removed, len(tilequeue.failures)))
+    if tilequeue.total:
+        print('{:.1f}% of the tiles had changed'
+              .format(100.0 * writer.count / tilequeue.total))
+
 def polygon2mbtiles(infile, optsin = {}):
     """Take an Area of Interest (AOI) polygon, return an MBtiles file."""
 
@@ -27,21 +94,141 @@ def polygon2mbtiles(infile, optsin = {}):
     csvfile = '{}_{}.csv'.format(basename, opts['tileserver'])
     foldername = '{}_{}'.format(basename, opts['tileserver'])
 
-    print('\nCreating the CSV list of tiles in {}\n'.format(csvfile))
-    # DEBUGGING OPTS
-    print(opts)
-    create_tile_list(infile, opts)
-    
-    print('Downloading the tiles into {}\n'.format(foldername))
-    opts['csvinfile'] = csvfile
-    download_all_tiles_in_csv(csvfile, opts)
-    
-    print('Converting all tiles to JPEG format to save space.')
-    convert_and_compress_tiles(foldername)
-    
-    print('Writing the actual MBTiles file {}{}'.format(foldername, '.mbtiles'))
-    opts['tiledir'] = foldername
-    write_mbtiles(foldername, opts)
+    server = get_tileserver(opts)
+    if (server and server.maxzoom is not None and
+        int(opts['maxzoom']) > server.maxzoom):
+        print('{} only has tiles up to zoom level {}, so stopping there'
+              .format(server.name, server.maxzoom))
+        opts['maxzoom'] = server.maxzoom
+        opts['minzoom'] = min(int(opts['minzoom']), server.maxzoom)
+
+    metrics = Metrics()
+    journalfile = '{}_journal.sqlite'.format(foldername)
+    journal = None if opts['no_journal'] else TileJournal(journalfile)
+    url_template = get_url_template(opts)
+    mbtilesfile = '{}.mbtiles'.format(foldername)
+    total = None   # number of tiles to download, if known in advance
+
+    if journal:
+        differences = journal.check_job(job_parameters(infile, opts,
+                                                       url_template))
+        if differences:
+            print('\n{} is the journal of a different job:'
+                  .format(journalfile))
+            for (name, recorded, value) in differences:
+                print('  {} was {}, not {}'.format(name, recorded, value))
+            print('Run this again with the same options to finish that job, '
+                  'or delete {} to start this one from scratch'
+                  .format(journalfile))
+            journal.close()
+            return
+        if (opts['direct'] and journal.counts().get('done') and
+            not os.path.exists(mbtilesfile + '.tmp' if journal.bulk_loading()
+                               else mbtilesfile)):
+            # The tiles the journal says are done went into a file which
+            # is no longer there, so they have to be downloaded again
+            print('{} is gone, so downloading its {} tiles again'.format(
+                  mbtilesfile, journal.forget_done()))
+
+    if journal and journal.enumerated():
+        counts = journal.counts()
+        unfinished = counts.get('pending', 0) + counts.get('failed', 0)
+        print('\nResuming the job recorded in {}: {} of {} tiles left to '
+              'download\n'.format(journalfile, unfinished,
+                                  sum(counts.values())))
+        total = unfinished
+        tiles = tiles_with_urls(metrics.timed('enumerate',
+                                              journal.pending_tiles()),
+                                url_template)
+    elif opts['write_csv']:
+        print('\nCreating the CSV list of tiles in {}\n'.format(csvfile))
+        with metrics.stage('enumerate'):
+            create_tile_list(infile, opts)
+        tiles = read_tile_csv(csvfile)
+    else:
+        # Stream tiles straight from the AOI into the downloader
+        tiles = tiles_with_urls(metrics.timed('enumerate',
+                                              generate_tile_list(infile, opts)),
+                                url_template)
+    validators = None
+    if opts['refresh'] and os.path.exists(mbtilesfile):
+        # Ask the server for every tile again, but only take the ones
+        # that have changed, straight into the existing file. Going to
+        # the server is the point, so skip the tile cache.
+        validators = TileValidators(mbtilesfile)
+        if not validators.count:
+            print('{} has no ETag or Last-Modified dates recorded, so every '
+                  'tile will be downloaded again'.format(mbtilesfile))
+        (opts['direct'], opts['update'], opts['no_cache']) = (True, True,
+                                                              True)
+    elif opts['update']:
+        # Only download what the existing MBTiles file does not have
+        tiles = missing_tiles(tiles, mbtilesfile)
+    if journal and not journal.enumerated():
+        tiles = journal.add_tiles(tiles)
+
+    if opts['direct']:
+        # Compress each tile as it arrives and put it straight into the
+        # MBTiles file, with no folder of tiles in between. When resuming,
+        # add to the file (or the unfinished .tmp file) the interrupted
+        # run left behind.
+        print('Downloading the tiles straight into {}\n'.format(mbtilesfile))
+        resuming = bool(journal and journal.counts())
+        # Tiles only count as done in the journal once they are committed
+        committed = journal.record_all if journal else None
+        writer = MBTilesWriter(mbtilesfile, opts,
+                               append = resuming or opts['update'],
+                               committed = committed, metrics = metrics,
+                               resume = bool(journal and
+                                             journal.bulk_loading()))
+        if journal:
+            # Only a temporary file this job's journal knows about is
+            # carried on with, if this run is interrupted too
+            journal.set_bulk_loading(writer.bulk)
+        blank = get_blank_detector(opts, server)
+        tilequeue = download_tiles(tiles, foldername, opts, journal,
+                                   partial(store_in_mbtiles, writer, server,
+                                           blank, metrics = metrics),
+                                   validators, metrics, total)
+        writer.close()
+        if journal:
+            journal.set_bulk_loading(False)  # the file is in place now
+        if opts['verbose']:
+            blank.report()
+        if validators:
+            validators.close()
+            report_refresh(tilequeue, writer)
+    else:
+        print('Downloading the tiles into {}\n'.format(foldername))
+        tilequeue = download_tiles(tiles, foldername, opts, journal,
+                                   metrics = metrics, total = total)
+
+        # The compressed tiles go straight from the compression processes
+        # into the MBTiles file, rather than being read back off the disk
+        print('Converting all tiles to {} format to save space, and writing '
+              'the actual MBTiles file {}{}'.format(opts['format'], foldername,
+                                                    '.mbtiles'))
+        writer = MBTilesWriter(mbtilesfile, opts, append = opts['update'],
+                               metrics = metrics)
+        # When updating, the tiles in the folder from earlier runs are
+        # already in the file; only the ones downloaded now need adding
+        stored = None
+        if opts['update']:
+            stored = (journal.done_tiles() if journal
+                      else tilequeue.stored_tiles())
+        convert_and_compress_tiles(foldername, opts, writer, metrics, stored)
+        writer.close()
+    metrics.count('write', writer.count)
+    write_report(metrics, opts['report'] or
+                 '{}_report.json'.format(foldername), tilequeue, opts)
+
+    if journal:
+        journal.close()
+        if tilequeue.failures:
+            print('Some tiles failed to download. Run this again to retry '
+                  'them (and only them) using {}'.format(journalfile))
+        else:
+            os.remove(journalfile)
     
 if __name__ == "__main__":
 
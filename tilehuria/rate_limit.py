@@ -0,0 +1,196 @@
+#!/usr/bin/python3
+"""
+Keep tile downloads to a rate the tileservers are happy with.
+
+Every tile host gets a token bucket: requests can go out in a burst of up
+to burst at once, and after that at rate per second. The tileserver as a
+whole can also be given a bucket of its own, shared by all its hosts.
+Rather than failing when the bucket is empty, a download waits its turn.
+
+When a server answers 429 Too Many Requests, nothing more is sent to that
+host until its Retry-After time has passed (or for a second, if it does
+not say), and its rate is halved: a steady rate the server accepts gets
+more tiles through than bursts that end up being retried. Once the server
+has been quiet for a while, the rate creeps back up a step at a time
+towards the rate it started with, so that a bad minute early on does not
+slow down the rest of a long job. A 503 Service Unavailable with a
+Retry-After is honoured the same way; without one, it is taken as a
+passing failure of that tile, which is simply tried again later.
+
+For URL templates with a {switch:} of mirror servers, each tile goes to
+whichever mirror can take it soonest.
+"""
+import sys, os
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlsplit
+
+from utils import compile_url_template
+
+DEFAULT_PAUSE = 1.0  # seconds, after a 429 without a Retry-After
+RECOVERY_INTERVAL = 10.0  # seconds without a 429 before each step back up
+RECOVERY_STEP = 0.1       # of the starting rate, added at each step
+
+class TokenBucket:
+    """Allows rate events per second, or burst at once. rate None means no
+       limit. Safe to share between threads."""
+
+    def __init__(self, rate = None, burst = None):
+        self.rate = float(rate) if rate else None
+        self.burst = max(1.0, float(burst or self.rate or 1))
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.max_rate = self.rate   # the rate to recover to after a cut
+        self.slowed = 0.0    # when the rate was last cut
+        self.changed = 0.0   # when the rate was last cut or raised
+        self.lock = threading.Lock()
+
+    def _refill(self, now):
+        if self.rate:
+            self.tokens = min(self.burst,
+                              self.tokens + (now - self.updated) * self.rate)
+            self._recover(now)
+        self.updated = now
+
+    def _recover(self, now):
+        """Raise a cut rate by a step, if it has been quiet long enough"""
+        if (self.rate < self.max_rate and
+            now - self.changed > RECOVERY_INTERVAL):
+            self.rate = min(self.max_rate,
+                            self.rate + self.max_rate * RECOVERY_STEP)
+            self.changed = now
+
+    def delay(self, now = None):
+        """Seconds until the next event would be allowed, without taking a
+           token"""
+        now = time.monotonic() if now is None else now
+        with self.lock:
+            wait = max(0.0, self.paused_until - now)
+            if self.rate:
+                self._refill(now)
+                wait = max(wait, (1 - self.tokens) / self.rate)
+            return wait
+
+    def reserve(self):
+        """Take a token, returning the seconds to wait before using it.
+           Tokens can be taken ahead of time, so callers queue up in turn."""
+        now = time.monotonic()
+        with self.lock:
+            wait = max(0.0, self.paused_until - now)
+            if self.rate:
+                self._refill(now)
+                self.tokens -= 1
+                if self.tokens < 0:
+                    wait = max(wait, -self.tokens / self.rate)
+            return wait
+
+    def pause(self, seconds):
+        """Allow nothing for a number of seconds"""
+        with self.lock:
+            self.paused_until = max(self.paused_until,
+                                    time.monotonic() + seconds)
+
+    def slow_down(self, factor = 0.5, minimum = 0.1, interval = 1.0):
+        """Cut the rate, if there is one, at most once per interval: the
+           requests already on their way will meet the same answer"""
+        now = time.monotonic()
+        with self.lock:
+            if self.rate and now - self.slowed > interval:
+                self.rate = max(minimum, self.rate * factor)
+                (self.slowed, self.changed) = (now, now)
+
+def retry_after(headers):
+    """Seconds to wait from a Retry-After header (seconds or an HTTP date),
+       or None if there is none"""
+    value = None
+    for (name, v) in (headers or {}).items():
+        if name.lower() == 'retry-after':
+            value = v.strip()
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError, IndexError):
+        return None
+
+class RateLimiter:
+    """Token buckets per host and for the tileserver as a whole"""
+
+    def __init__(self, rate = None, burst = None, total_rate = None,
+                 url_template = None):
+        self.rate = rate
+        self.burst = burst
+        self.total = TokenBucket(total_rate)
+        self.hosts = {}
+        self.lock = threading.Lock()
+        self.template = (compile_url_template(url_template)
+                         if url_template else None)
+        self.waited = 0.0     # seconds spent waiting for a turn
+        self.throttled = 0    # responses telling us to slow down
+
+    def bucket(self, host):
+        with self.lock:
+            if host not in self.hosts:
+                self.hosts[host] = TokenBucket(self.rate, self.burst)
+            return self.hosts[host]
+
+    def mirrors(self, z, x, y, url):
+        """The URLs of a tile on each mirror server of the template, if the
+           URL was made from it, or else just the URL"""
+        if self.template is None or not self.template.switches:
+            return [url]
+        urls = self.template.mirror_urls(int(x), int(y), int(z))
+        return urls if url in urls else [url]
+
+    def acquire(self, z, x, y, url):
+        """Choose where to download a tile from and take a turn there.
+           Returns (url, seconds to wait before downloading)."""
+        candidates = self.mirrors(z, x, y, url)
+        if len(candidates) > 1:
+            now = time.monotonic()
+            url = min(candidates,
+                      key = lambda u: self.bucket(urlsplit(u).netloc)
+                                      .delay(now))
+        wait = max(self.bucket(urlsplit(url).netloc).reserve(),
+                   self.total.reserve())
+        with self.lock:
+            self.waited += wait
+        return (url, wait)
+
+    def wait(self, z, x, y, url):
+        """Block until it is a tile's turn; returns the URL to download"""
+        (url, wait) = self.acquire(z, x, y, url)
+        if wait > 0:
+            time.sleep(wait)
+        return url
+
+    def feedback(self, url, response):
+        """Back off from a host which says it is overloaded"""
+        if response.status not in (429, 503):
+            return
+        host = self.bucket(urlsplit(url).netloc)
+        seconds = retry_after(response.headers)
+        if seconds is None and response.status == 503:
+            return
+        host.pause(DEFAULT_PAUSE if seconds is None else seconds)
+        if response.status == 429:
+            host.slow_down()
+        with self.lock:
+            self.throttled += 1
+
+def get_rate_limiter(opts, server = None):
+    """A RateLimiter for the options and TileServer. --rate_limit and
+       --total_rate override the server's own rate and total_rate."""
+    rate = opts.get('rate_limit') or (server.rate if server else None)
+    burst = server.burst if server else None
+    total_rate = opts.get('total_rate') or (server.total_rate if server
+                                            else None)
+    url_template = opts.get('url_template') or (server.url_template
+                                                if server else None)
+    return RateLimiter(rate, burst, total_rate, url_template)
@@ -2,11 +2,18 @@
 
 import sys, os
 import argparse
-import math
+import io
 import sqlite3
 from sqlite3 import Error
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image
 
 from arguments import argumentlist, set_defaults
+from composite_tiles import merge_images
+
+BATCH_SIZE = 1000     # tiles read from the database at a time
+WRITER_THREADS = 8    # threads writing tile files
 
 def connect(infile):
     try:
@@ -61,7 +68,7 @@ def read_mbtiles(infile, opts = {}):
     
         # infofile.write all rows in tiles table
         infofile.write('Columns in tiles table:\n')
-        cursor.execute("SELECT * FROM tiles;")
+        cursor.execute("SELECT * FROM tiles LIMIT 0;")
         columns = cursor.description
         for column in columns:
             infofile.write(column[0])
@@ -69,42 +76,114 @@ def read_mbtiles(infile, opts = {}):
         infofile.write('\n')
     
         infofile.write('Number of rows in tiles table: ')
-        rows = cursor.fetchall()
-        infofile.write(str(len(rows)))
+        cursor.execute("SELECT COUNT(*) FROM tiles;")
+        infofile.write(str(cursor.fetchone()[0]))
         infofile.write('\n')
 
+        # Tiles sharing a z/x/y get the suffixes 1, 2, 3... after the first,
+        # counted here rather than by looking for files already on disk
+        duplicates = duplicate_counts(cursor)
+        copies = {}    # (z, x, tile row): copies of a duplicate seen so far
+        group = []     # the copies of one duplicate, to be composited
+        composite = opts.get('composite')
+
         infofile.write('Individual tile filenames: \n')
-        for row in rows:
-            (z, x, tiley) = (str(row[0]), str(row[1]), str(row[2]))
-            y = int(math.pow(2.0, float(z)) - float(tiley) - 1.0)
-            infofile.write('{}/{}/{}.{}\n'.format(z, x, y, image_format))
-            path_to_dir = os.path.join(outdirpath, z, x)
-            check_dir(path_to_dir)
-            ofname = os.path.join(path_to_dir, '{}.{}'.format(y, image_format))
-            oftowrite = get_unique_fn(ofname)
-            with open(oftowrite, 'wb') as outfile:
-                outfile.write(row[3])
+        # With duplicates, read the copies of each tile one after another,
+        # so that each is finished with before the next comes along
+        cursor.execute("SELECT zoom_level, tile_column, tile_row, tile_data "
+                       "FROM tiles{};".format(
+                           " ORDER BY zoom_level, tile_column, tile_row"
+                           if duplicates else ""))
+        made_dirs = set()
+        pending = []
+        with ThreadPoolExecutor(WRITER_THREADS) as executor:
+            # Read the tiles a batch at a time rather than all at once, and
+            # write each batch out while the next one is being read
+            while True:
+                rows = cursor.fetchmany(BATCH_SIZE)
+                if not rows:
+                    break
+                futures = []
+                for (z, x, tiley, data) in rows:
+                    y = 2 ** z - tiley - 1
+                    path_to_dir = os.path.join(outdirpath, str(z), str(x))
+                    if (z, x) not in made_dirs:
+                        check_dir(path_to_dir)
+                        made_dirs.add((z, x))
+                    filename = '{}.{}'.format(y, image_format)
+                    key = (z, x, tiley)
+                    if key in duplicates:
+                        seen = copies.pop(key, 0)
+                        if seen:
+                            filename += str(seen)
+                        if seen + 1 < duplicates[key]:
+                            copies[key] = seen + 1
+                        if composite:
+                            group.append(data)
+                            compositename = '{}.jpg'.format(y)
+                            if len(group) == duplicates[key]:
+                                futures.append(executor.submit(
+                                    write_composite,
+                                    os.path.join(path_to_dir, compositename),
+                                    group))
+                                group = []
+                            if filename == compositename:
+                                # It would be overwritten by the composite
+                                continue
+                    infofile.write('{}/{}/{}\n'.format(z, x, filename))
+                    futures.append(executor.submit(
+                        write_tile, os.path.join(path_to_dir, filename), data))
+                for future in pending:
+                    future.result()
+                pending = futures
+            for future in pending:
+                future.result()
     
         cursor.close()
         connection.close()
 
-def get_unique_fn(ofname):
-    while(os.path.isfile(ofname)):
-        endchar = ofname[-1]
-        if endchar.isdigit():
-            endnum = int(endchar) + 1
-            ofname = ofname[:-1] + str(endnum)
-        # It was a duplicate but the first one (no number yet appended)
-        else:
-            ofname = ofname + '1'
-    return ofname
-               
+def has_unique_index(cursor):
+    """True if a unique index on z/x/y rules out duplicate tiles"""
+    for table in ('tiles', 'map'):
+        for index in cursor.execute('PRAGMA index_list({});'.format(table)).fetchall():
+            (name, unique) = (index[1], index[2])
+            columns = [row[2] for row in cursor.execute(
+                'PRAGMA index_info("{}");'.format(name)).fetchall()]
+            if unique and sorted(columns) == ['tile_column', 'tile_row',
+                                              'zoom_level']:
+                return True
+    return False
+
+def duplicate_counts(cursor):
+    """Returns {(zoom, column, tile row): number of tiles} for every z/x/y
+       with more than one tile, from a single GROUP BY query"""
+    if has_unique_index(cursor):
+        return {}
+    cursor.execute('SELECT zoom_level, tile_column, tile_row, COUNT(*) '
+                   'FROM tiles GROUP BY zoom_level, tile_column, tile_row '
+                   'HAVING COUNT(*) > 1;')
+    return {(z, x, tiley): count for (z, x, tiley, count) in cursor.fetchall()}
+
+def write_tile(ofname, data):
+    with open(ofname, 'wb') as outfile:
+        outfile.write(data)
+
+def write_composite(ofname, tiles):
+    """Merge the images of duplicate tiles into one JPEG"""
+    try:
+        pics = [Image.open(io.BytesIO(data)) for data in tiles]
+        merge_images(pics).save(ofname, "JPEG")
+    except Exception as e:
+        print('Could not composite the tiles for {}: {}'.format(ofname, e))
 
 if __name__ == '__main__':
     p = argparse.ArgumentParser()
     p.add_argument("infile", help = "An MBTile file to be read.")
     p.add_argument("-od", "--output_dir",
                    help = "The directory to store extracted tiles.")
+    p.add_argument("-cm", "--composite", action = 'store_true',
+                   help = "Where there is more than one tile for the same "
+                   "place, also merge them into one JPEG tile.")
     p.add_argument("-v", "--verbose", action = 'store_true',
                         help = "Use if you want to see a lot of "
                         "command line output flash by!")
@@ -0,0 +1,245 @@
+#!/usr/bin/python3
+"""
+A tile cache on disk, shared by every job (and every AOI) on the computer,
+so that overlapping areas do not download the same tiles again.
+
+Tiles are kept by (tileserver, zoom, x, y) in a small SQLite index, with
+the tile data itself stored once per distinct content, in files named by
+the SHA-1 hash of their bytes (so a placeholder tile the server sent a
+million times takes up the space of one).
+
+A cached tile is used as it is for a while (the TTL). After that it is
+revalidated: asked for again with its ETag or Last-Modified date, so that
+the server can answer 304 Not Modified rather than sending it again.
+
+When the cache grows past its size limit, the least recently used tiles
+are thrown out.
+
+Tiles whose URLs were not made from the tileserver's URL template (say, a
+CSV of tiles from some other server) are kept by their own URL instead, so
+that tiles from different servers are never mixed up.
+"""
+import sys, os
+import sqlite3
+import hashlib
+import threading
+import time
+from collections import namedtuple
+
+from http_pool import TileResponse, header
+from utils import compile_url_template
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache',
+                                 'tilehuria')
+
+CachedTile = namedtuple('CachedTile', ['data', 'fresh', 'etag',
+                                       'last_modified'])
+
+class TileCache:
+    """The cached tiles of one tileserver, with the URL template its tile
+       URLs are made from. Safe to share between threads, and between
+       processes using the same directory."""
+
+    def __init__(self, directory, tileserver, url_template = None,
+                 max_bytes = 2000 * 1024 ** 2, ttl = 30 * 86400):
+        self.directory = directory
+        self.tileserver = tileserver
+        self.template = (compile_url_template(url_template)
+                         if url_template else None)
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.hits = 0         # tiles used from the cache without asking
+        self.revalidated = 0  # tiles the server said had not changed
+        self.puts = 0
+        self.accessed = []    # (time, key) of tiles used, not yet saved
+        self.lock = threading.Lock()
+        os.makedirs(os.path.join(directory, 'objects'), exist_ok = True)
+        self.db = sqlite3.connect(os.path.join(directory, 'index.sqlite'),
+                                  check_same_thread = False, timeout = 30)
+        self.db.execute('PRAGMA journal_mode=WAL;')
+        self.db.execute('PRAGMA synchronous=NORMAL;')
+        self.db.execute('''
+        CREATE TABLE IF NOT EXISTS tiles (tileserver TEXT, zoom_level INTEGER,
+            tile_column INTEGER, tile_row INTEGER, hash TEXT, etag TEXT,
+            last_modified TEXT, fetched REAL, accessed REAL,
+            PRIMARY KEY (tileserver, zoom_level, tile_column, tile_row))
+            WITHOUT ROWID;''')
+        self.db.execute('''
+        CREATE INDEX IF NOT EXISTS tiles_accessed on tiles (accessed);''')
+        self.db.execute('''
+        CREATE INDEX IF NOT EXISTS tiles_hash on tiles (hash);''')
+        self.db.execute('''
+        CREATE TABLE IF NOT EXISTS objects (hash TEXT PRIMARY KEY,
+            size INTEGER) WITHOUT ROWID;''')
+        self.db.commit()
+
+    def object_path(self, tile_hash):
+        return os.path.join(self.directory, 'objects', tile_hash[:2],
+                            tile_hash)
+
+    def source(self, url):
+        """What a tile is cached under: the tileserver, if the tile's URL
+           is one of its URLs, or else the URL itself"""
+        if self.template and self.template.matches(url):
+            return self.tileserver
+        return 'url:{}'.format(url)
+
+    def get(self, z, x, y, url):
+        """The CachedTile for a tile, or None if it is not in the cache"""
+        key = (self.source(url), int(z), int(x), int(y))
+        now = time.time()
+        with self.lock:
+            row = self.db.execute(
+                'SELECT hash, etag, last_modified, fetched FROM tiles '
+                'WHERE tileserver = ? AND zoom_level = ? AND '
+                'tile_column = ? AND tile_row = ?;', key).fetchone()
+            if row is None:
+                return None
+            (tile_hash, etag, last_modified, fetched) = row
+            try:
+                with open(self.object_path(tile_hash), 'rb') as f:
+                    data = f.read()
+            except OSError:
+                return None   # evicted by another process
+            # Access times only matter for eviction, so save them in bulk
+            self.accessed.append((now,) + key)
+            if len(self.accessed) >= 1000:
+                self._save_accessed()
+                self.db.commit()
+            fresh = now - fetched < self.ttl
+            if fresh:
+                self.hits += 1
+        return CachedTile(data, fresh, etag, last_modified)
+
+    def _save_accessed(self):
+        """Save the access times of the tiles used since last time, in the
+           current transaction"""
+        self.db.executemany(
+            'UPDATE tiles SET accessed = ? WHERE tileserver = ? AND '
+            'zoom_level = ? AND tile_column = ? AND tile_row = ?;',
+            self.accessed)
+        self.accessed = []
+
+    def validators(self, cached):
+        """Headers to make a request conditional on a cached tile having
+           changed"""
+        headers = {}
+        if cached and cached.etag:
+            headers['If-None-Match'] = cached.etag
+        if cached and cached.last_modified:
+            headers['If-Modified-Since'] = cached.last_modified
+        return headers
+
+    def update(self, z, x, y, url, cached, response):
+        """Record a server response for a tile in the cache. Returns the
+           response, with the cached tile in it if the server said 304
+           Not Modified."""
+        if response.status == 304 and cached:
+            self.put(z, x, y, url, cached.data, cached.etag,
+                     cached.last_modified)
+            with self.lock:
+                self.revalidated += 1
+            return TileResponse(200, response.headers, cached.data)
+        if response.status == 200:
+            self.put(z, x, y, url, response.data,
+                     header(response.headers, 'ETag'),
+                     header(response.headers, 'Last-Modified'))
+        return response
+
+    def put(self, z, x, y, url, data, etag = None, last_modified = None):
+        """Add or replace a tile in the cache"""
+        tile_hash = hashlib.sha1(data).hexdigest()
+        path = self.object_path(tile_hash)
+        now = time.time()
+        with self.lock:
+            if not os.path.exists(path):
+                os.makedirs(os.path.dirname(path), exist_ok = True)
+                temp = '{}.{}.tmp'.format(path, threading.get_ident())
+                with open(temp, 'wb') as f:
+                    f.write(data)
+                os.replace(temp, path)
+            self.db.execute('INSERT OR IGNORE INTO objects (hash, size) '
+                            'VALUES (?, ?);', (tile_hash, len(data)))
+            self.db.execute(
+                'INSERT OR REPLACE INTO tiles VALUES (?,?,?,?,?,?,?,?,?);',
+                (self.source(url), int(z), int(x), int(y), tile_hash, etag,
+                 last_modified, now, now))
+            self._save_accessed()
+            self.db.commit()
+            self.puts += 1
+            check = self.puts % 1000 == 0
+        if check:
+            self.evict()
+
+    def size(self):
+        """Bytes of tile data in the cache"""
+        with self.lock:
+            return self.db.execute(
+                'SELECT COALESCE(SUM(size), 0) FROM objects;').fetchone()[0]
+
+    def evict(self):
+        """Throw out the least recently used tiles until the cache is under
+           its size limit (with some room to spare). Returns the number of
+           tiles thrown out."""
+        evicted = 0
+        with self.lock:
+            self._save_accessed()
+            self.db.commit()
+        total = self.size()
+        if total <= self.max_bytes:
+            return 0
+        with self.lock:
+            while total > self.max_bytes * 0.9:
+                rows = self.db.execute(
+                    'SELECT tileserver, zoom_level, tile_column, tile_row, '
+                    'hash FROM tiles ORDER BY accessed LIMIT 1000;').fetchall()
+                if not rows:
+                    break
+                for row in rows:
+                    if total <= self.max_bytes * 0.9:
+                        break
+                    self.db.execute(
+                        'DELETE FROM tiles WHERE tileserver = ? AND '
+                        'zoom_level = ? AND tile_column = ? AND '
+                        'tile_row = ?;', row[:4])
+                    evicted += 1
+                    total -= self._forget_unused(row[4])
+                self.db.commit()
+        return evicted
+
+    def _forget_unused(self, tile_hash):
+        """Delete content no longer used by any tile. Returns the bytes
+           freed."""
+        if self.db.execute('SELECT 1 FROM tiles WHERE hash = ? LIMIT 1;',
+                           (tile_hash,)).fetchone():
+            return 0
+        size = self.db.execute('SELECT size FROM objects WHERE hash = ?;',
+                               (tile_hash,)).fetchone()
+        self.db.execute('DELETE FROM objects WHERE hash = ?;', (tile_hash,))
+        try:
+            os.remove(self.object_path(tile_hash))
+        except OSError:
+            pass
+        return size[0] if size else 0
+
+    def close(self):
+        with self.lock:
+            self._save_accessed()
+            self.db.commit()
+            self.db.close()
+
+def get_tile_cache(opts, server):
+    """The TileCache for the options and TileServer, or None if caching is
+       turned off or the tileserver is not known"""
+    if opts.get('no_cache') or server is None:
+        return None
+    name = server.name
+    if name == 'from_url':
+        # Tiles from a template given on the command line are cached by
+        # the template, so that different servers are not mixed up
+        name = 'url:{}'.format(server.url_template)
+    return TileCache(opts.get('cache_dir') or DEFAULT_CACHE_DIR, name,
+                     server.url_template,
+                     max_bytes = float(opts.get('cache_size') or 2000)
+                                 * 1024 ** 2,
+                     ttl = float(opts.get('cache_ttl') or 30) * 86400)
@@ -0,0 +1,296 @@
+#!/usr/bin/python3
+"""
+Enumerate the tiles that intersect an Area of Interest (AOI).
+
+Testing every tile in the bounding box against the AOI costs one GEOS call
+per tile, which at high zoom levels means millions of calls for tiles that
+are nowhere near a thin or diagonal polygon. Two faster methods are offered:
+
+quadtree: test a tile once, then treat all of its children as fully inside
+          (the AOI contains the tile), fully outside (no intersection), or
+          split it and test the four children.
+scanline: test each row of tiles once, then bisect the row into spans of
+          tiles which are fully inside, fully outside, or split again.
+
+Both yield exactly the same tiles, in the same order (zoom, then row, then
+column), as the brute force method of testing every tile.
+
+With more than one process, the work is split into shards: each zoom level,
+and at the higher zoom levels bands of rows within it, in proportion to the
+number of tiles in the bounding box. The shards are worked on by a pool of
+processes, each of which rebuilds the AOI geometry from WKB once, and the
+tiles are put back together in shard order, which is the same order as
+enumerating them in a single process. The tiles are usually taken by the
+download threads as they need them, so the pool's processes are started by
+a fork server (or spawned, where there is none) rather than forked from a
+process with threads running, and they exit once the last shard is done.
+Only a few shards are worked on ahead of the tiles being taken, and no
+shard is bigger than SHARD_TILES tiles of the bounding box, so that the
+tiles found do not pile up in memory. A bounding box of fewer than
+MIN_SHARDED_TILES tiles is not worth starting the processes for.
+"""
+# Ivan Buendia Gayton, Humanitarian OpenStreetMap Team/Ramani Huria 2018
+import sys, os
+import math
+import multiprocessing
+from collections import deque
+import numpy as np
+from osgeo import ogr
+
+from tile_math import lat_lon_to_tiles, expand_runs
+
+from geo_utils import tile_block_polygon
+from geo_utils import get_union
+
+ENUMERATION_METHODS = ('quadtree', 'scanline', 'bruteforce')
+SHARDS_PER_PROCESS = 4   # so that the work evens out between processes
+SHARDS_IN_FLIGHT = 2     # per process, ahead of the tiles being taken
+SHARD_TILES = 1000000    # most tiles of the bounding box in a shard
+MIN_SHARDED_TILES = 100000
+# Forking a process with threads can copy a lock some other thread holds
+START_METHOD = ('forkserver'
+                if 'forkserver' in multiprocessing.get_all_start_methods()
+                else 'spawn')
+
+# The AOI geometry and its union, rebuilt once in each worker process
+shard_geometry = None
+
+def tile_ranges(xmin, xmax, ymin, ymax, minzoom, maxzoom):
+    """Returns {zoom: (left, top, right, bottom)} tile addresses of the
+       bounding box at each zoom level"""
+    zooms = np.arange(minzoom, maxzoom + 1)
+    # Upper left and lower right tiles, for all zoom levels at once
+    (lefts, tops) = lat_lon_to_tiles(ymax, xmin, zooms)
+    (rights, bottoms) = lat_lon_to_tiles(ymin, xmax, zooms)
+    return {int(zoom): (int(left), int(top), int(right), int(bottom))
+            for (zoom, left, top, right, bottom)
+            in zip(zooms, lefts, tops, rights, bottoms)}
+
+def box_tiles(extent, minzoom, maxzoom):
+    """The number of tiles in the bounding box from minzoom to maxzoom,
+       which is at least the number intersecting the AOI"""
+    return sum((right - left + 1) * (bottom - top + 1)
+               for (left, top, right, bottom)
+               in tile_ranges(*extent, minzoom, maxzoom).values())
+
+def tile_range(xmin, xmax, ymin, ymax, zoom):
+    """Returns (left, top, right, bottom) tile addresses of the bounding box"""
+    return tile_ranges(xmin, xmax, ymin, ymax, zoom, zoom)[zoom]
+
+def contains(union, poly):
+    """True if the dissolved AOI geometry entirely contains the polygon"""
+    return union is not None and union.Contains(poly)
+
+def band(top, bottom, rows):
+    """The rows from top to bottom, limited to a (first, last) band of rows
+       if one is given"""
+    if rows:
+        (top, bottom) = (max(top, rows[0]), min(bottom, rows[1]))
+    return range(top, bottom + 1)
+
+def bruteforce_tiles(geomcollection, extent, zoom, rows = None):
+    """Yield (x, y) of every tile intersecting the AOI, testing each one"""
+    (left, top, right, bottom) = tile_range(*extent, zoom)
+    for tileY in band(top, bottom, rows):
+        for tileX in range(left, right + 1):
+            poly = tile_block_polygon(tileX, tileY, tileX, tileY, zoom)
+            if geomcollection.Intersect(poly):
+                yield (tileX, tileY)
+
+def fill_span(left, right, tileY, zoom, geomcollection, union):
+    """Yield (x, y) of tiles intersecting the AOI in a span of a tile row.
+       The span is tested as a whole and bisected only where it crosses
+       the edge of the AOI. Tiles come out from left to right."""
+    poly = tile_block_polygon(left, tileY, right, tileY, zoom)
+    if not geomcollection.Intersect(poly):
+        return
+    if left == right:
+        yield (left, tileY)
+    elif contains(union, poly):
+        for tileX in range(left, right + 1):
+            yield (tileX, tileY)
+    else:
+        middle = (left + right) // 2
+        yield from fill_span(left, middle, tileY, zoom, geomcollection, union)
+        yield from fill_span(middle + 1, right, tileY, zoom,
+                             geomcollection, union)
+
+def scanline_tiles(geomcollection, extent, zoom, union = None, rows = None):
+    """Yield (x, y) of every tile intersecting the AOI, one row at a time"""
+    (left, top, right, bottom) = tile_range(*extent, zoom)
+    for tileY in band(top, bottom, rows):
+        yield from fill_span(left, right, tileY, zoom, geomcollection, union)
+
+def quadtree_runs(geomcollection, extent, minzoom, maxzoom, union = None,
+                  rows = None):
+    """Walk the quadtree from zoom 0 down to maxzoom, pruning at each tile.
+       Returns a dict of {zoom: {tileY: [(first tileX, last tileX), ...]}}
+       with one run per tile on the AOI edge and one run per row of every
+       block of tiles found entirely inside the AOI. With a (first, last)
+       band of rows at a single zoom level, only tiles over the band are
+       walked."""
+    ranges = tile_ranges(*extent, minzoom, maxzoom)
+    if rows:
+        (left, top, right, bottom) = ranges[maxzoom]
+        ranges[maxzoom] = (left, max(top, rows[0]), right,
+                           min(bottom, rows[1]))
+    runs = {zoom: {} for zoom in ranges}
+
+    def add_block(tileX, tileY, zoom):
+        """Add the tile and all of its descendants down to maxzoom"""
+        for level in range(max(zoom, minzoom), maxzoom + 1):
+            scale = 2 ** (level - zoom)
+            (left, top, right, bottom) = ranges[level]
+            first = max(tileX * scale, left)
+            last = min((tileX + 1) * scale - 1, right)
+            if first > last:
+                continue
+            for row in range(max(tileY * scale, top),
+                             min((tileY + 1) * scale - 1, bottom) + 1):
+                runs[level].setdefault(row, []).append((first, last))
+
+    # Explicit stack rather than recursion; the order does not matter as
+    # the runs are sorted when the tiles are yielded
+    stack = [(0, 0, 0)]
+    while stack:
+        (tileX, tileY, zoom) = stack.pop()
+        if rows:
+            scale = 2 ** (maxzoom - zoom)
+            if (tileY + 1) * scale - 1 < rows[0] or tileY * scale > rows[1]:
+                continue
+        poly = tile_block_polygon(tileX, tileY, tileX, tileY, zoom)
+        if not geomcollection.Intersect(poly):
+            continue
+        if zoom == maxzoom or contains(union, poly):
+            add_block(tileX, tileY, zoom)
+            continue
+        if zoom >= minzoom:
+            (left, top, right, bottom) = ranges[zoom]
+            if left <= tileX <= right and top <= tileY <= bottom:
+                runs[zoom].setdefault(tileY, []).append((tileX, tileX))
+        for (dx, dy) in ((0, 0), (1, 0), (0, 1), (1, 1)):
+            stack.append((tileX * 2 + dx, tileY * 2 + dy, zoom + 1))
+    return runs
+
+def quadtree_tiles(geomcollection, extent, minzoom, maxzoom, union = None):
+    """Yield (zoom, x, y) of every tile intersecting the AOI, zoom by zoom"""
+    runs = quadtree_runs(geomcollection, extent, minzoom, maxzoom, union)
+    for zoom in range(minzoom, maxzoom + 1):
+        (tileXs, tileYs) = expand_runs(runs[zoom])
+        for (tileX, tileY) in zip(tileXs.tolist(), tileYs.tolist()):
+            yield (zoom, tileX, tileY)
+
+def plan_shards(extent, minzoom, maxzoom, num_shards):
+    """Split the tiles of the bounding box into about num_shards shards of
+       (zoom, (first row, last row)), or more if that is needed to keep
+       them to about SHARD_TILES tiles each, each zoom level getting a share
+       of bands of rows in proportion to its number of tiles. Returns them
+       in order of zoom, then row."""
+    ranges = tile_ranges(*extent, minzoom, maxzoom)
+    cells = {zoom: (right - left + 1) * (bottom - top + 1)
+             for (zoom, (left, top, right, bottom)) in ranges.items()}
+    total = sum(cells.values())
+    num_shards = max(num_shards, math.ceil(total / SHARD_TILES))
+    shards = []
+    for zoom in range(minzoom, maxzoom + 1):
+        (left, top, right, bottom) = ranges[zoom]
+        bands = max(1, min(bottom - top + 1,
+                           int(round(num_shards * cells[zoom] / total))))
+        edges = np.linspace(top, bottom + 1, bands + 1).astype(np.int64)
+        for (first, end) in zip(edges[:-1].tolist(), edges[1:].tolist()):
+            if end > first:
+                shards.append((zoom, (first, end - 1)))
+    return shards
+
+def init_shard_worker(wkb, method):
+    """Rebuild the AOI geometry (and its union, if the method needs it) in
+       a worker process"""
+    global shard_geometry
+    geomcollection = ogr.CreateGeometryFromWkb(wkb)
+    union = get_union(geomcollection) if method != 'bruteforce' else None
+    shard_geometry = (geomcollection, union)
+
+def enumerate_shard(shard):
+    """Find the tiles of one (method, extent, zoom, rows) shard in a worker
+       process. Returns arrays of their x and y, ordered by row, then
+       column."""
+    (method, extent, zoom, rows) = shard
+    (geomcollection, union) = shard_geometry
+    if method == 'quadtree':
+        runs = quadtree_runs(geomcollection, extent, zoom, zoom, union, rows)
+        return expand_runs(runs[zoom])
+    if method == 'scanline':
+        tiles = list(scanline_tiles(geomcollection, extent, zoom, union, rows))
+    else:
+        tiles = list(bruteforce_tiles(geomcollection, extent, zoom, rows))
+    return (np.array([tile[0] for tile in tiles], dtype = np.int64),
+            np.array([tile[1] for tile in tiles], dtype = np.int64))
+
+def sharded_tiles(geomcollection, extent, shards, method, processes):
+    """Yield (zoom, x, y) of every tile intersecting the AOI, found shard by
+       shard on a pool of processes, in the same order as tiles_in_aoi"""
+    wkb = bytes(geomcollection.ExportToWkb())
+    context = multiprocessing.get_context(START_METHOD)
+    pool = context.Pool(processes, init_shard_worker, (wkb, method))
+    waiting = deque(shards)
+    in_flight = deque()  # (zoom, result) of the shards handed out, in order
+    try:
+        while waiting or in_flight:
+            # Keep only a few shards ahead of the tiles being taken
+            while waiting and len(in_flight) < processes * SHARDS_IN_FLIGHT:
+                (zoom, rows) = waiting.popleft()
+                in_flight.append((zoom, pool.apply_async(
+                    enumerate_shard, ((method, extent, zoom, rows),))))
+                if not waiting:
+                    # No more work: the processes exit once it is done
+                    pool.close()
+            (zoom, result) = in_flight.popleft()
+            (tileXs, tileYs) = result.get()
+            if not waiting and not in_flight:
+                # Every shard is back, so the pool is finished with long
+                # before the tiles of the last shard are
+                pool.join()
+            for (tileX, tileY) in zip(tileXs.tolist(), tileYs.tolist()):
+                yield (zoom, tileX, tileY)
+    finally:
+        # Stops the processes if the rest of the tiles are not wanted
+        pool.terminate()
+
+def tiles_in_aoi(geomcollection, extent, minzoom, maxzoom,
+                 method = 'quadtree', processes = 1):
+    """Yield (zoom, x, y) of all tiles from minzoom to maxzoom intersecting
+       the AOI geometry collection, ordered by zoom, then row, then column.
+       extent is (xmin, xmax, ymin, ymax) as returned by get_extent. With
+       more than one process, the work of a big enough AOI is shared
+       between them in shards."""
+    (minzoom, maxzoom) = (int(minzoom), int(maxzoom))
+    if method not in ENUMERATION_METHODS:
+        print('Unknown tile enumeration method {}, using quadtree'
+              .format(method))
+        method = 'quadtree'
+
+    processes = int(processes or 1)
+    if (processes > 1 and
+        box_tiles(extent, minzoom, maxzoom) >= MIN_SHARDED_TILES):
+        shards = plan_shards(extent, minzoom, maxzoom,
+                             processes * SHARDS_PER_PROCESS)
+        if len(shards) > 1:
+            yield from sharded_tiles(geomcollection, extent, shards, method,
+                                     processes)
+            return
+
+    if method == 'quadtree':
+        union = get_union(geomcollection)
+        yield from quadtree_tiles(geomcollection, extent,
+                                  minzoom, maxzoom, union)
+    elif method == 'scanline':
+        union = get_union(geomcollection)
+        for zoom in range(minzoom, maxzoom + 1):
+            for (tileX, tileY) in scanline_tiles(geomcollection, extent,
+                                                 zoom, union):
+                yield (zoom, tileX, tileY)
+    else:
+        for zoom in range(minzoom, maxzoom + 1):
+            for (tileX, tileY) in bruteforce_tiles(geomcollection,
+                                                   extent, zoom):
+                yield (zoom, tileX, tileY)
@@ -0,0 +1,212 @@
+#!/usr/bin/python3
+"""
+A journal of the state of every tile in a job, kept in a small SQLite file,
+so that an interrupted job can be restarted without redoing finished work.
+
+Each tile (zoom, x, y) is one of:
+    pending  enumerated but not yet downloaded
+    done     downloaded and stored
+    empty    the server has no tile here
+    failed   gave up after the maximum number of attempts (the reason is
+             kept); failed tiles are tried again when the job is resumed
+
+Once every tile of the Area of Interest has been recorded, a restarted job
+reads only the pending and failed tiles back out of the journal instead of
+enumerating the AOI again, so resuming costs O(pending), not O(all tiles).
+
+The parameters of the job (zoom levels, AOI, tileserver) are recorded with
+it, so that a journal is not resumed by a job asking for something else.
+"""
+import sys, os
+import sqlite3
+import threading
+import time
+
+UNFINISHED = ('pending', 'failed')
+
+class TileJournal:
+    """Tile states for one job. Safe to share between threads."""
+
+    def __init__(self, path, batch_size = 500, flush_interval = 5.0):
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.lock = threading.RLock()
+        self.updates = []    # (zoom, x, y, state, reason) waiting to be saved
+        self.last_flush = time.time()
+        self.db = sqlite3.connect(path, check_same_thread = False)
+        self.db.execute('PRAGMA journal_mode=WAL;')
+        self.db.execute('PRAGMA synchronous=NORMAL;')
+        self.db.execute('''
+        CREATE TABLE IF NOT EXISTS tiles (zoom_level INTEGER,
+            tile_column INTEGER, tile_row INTEGER, state TEXT, reason TEXT,
+            PRIMARY KEY (zoom_level, tile_column, tile_row)) WITHOUT ROWID;''')
+        self.db.execute('''
+        CREATE INDEX IF NOT EXISTS tile_state on tiles (state);''')
+        self.db.execute('''
+        CREATE TABLE IF NOT EXISTS job (name TEXT PRIMARY KEY, value TEXT);''')
+        self.db.commit()
+
+    def enumerated(self):
+        """True if every tile in the AOI has already been recorded"""
+        with self.lock:
+            row = self.db.execute("SELECT value FROM job "
+                                  "WHERE name = 'enumerated';").fetchone()
+            return bool(row and row[0] == '1')
+
+    def bulk_loading(self):
+        """True if the tiles done are going into a temporary file which has
+           not yet taken the place of the MBTiles file"""
+        with self.lock:
+            row = self.db.execute("SELECT value FROM job "
+                                  "WHERE name = 'bulk_loading';").fetchone()
+            return bool(row and row[0] == '1')
+
+    def set_bulk_loading(self, loading):
+        """Record whether the tiles done are going into a temporary file"""
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO job (name, value) "
+                            "VALUES ('bulk_loading', ?);",
+                            ('1' if loading else '0',))
+            self.db.commit()
+
+    def check_job(self, parameters):
+        """Record the parameters of the job, a dict of name: value, if the
+           journal does not have them yet. Returns a list of (name, recorded
+           value, value) of those that differ from the ones recorded."""
+        parameters = {name: str(value) for (name, value) in parameters.items()}
+        with self.lock:
+            recorded = dict(self.db.execute('SELECT name, value FROM job;'))
+            differences = [(name, recorded[name], value)
+                           for (name, value) in sorted(parameters.items())
+                           if name in recorded and recorded[name] != value]
+            if not differences:
+                self.db.executemany('INSERT OR REPLACE INTO job (name, value) '
+                                    'VALUES (?, ?);', parameters.items())
+                self.db.commit()
+            return differences
+
+    def counts(self):
+        """Returns {state: number of tiles}"""
+        with self.lock:
+            self.flush()
+            return dict(self.db.execute(
+                'SELECT state, COUNT(*) FROM tiles GROUP BY state;'))
+
+    def forget_done(self):
+        """Mark every tile done so far as pending again, for when what they
+           were stored in has been lost. Returns the number of tiles."""
+        with self.lock:
+            self.flush()
+            forgotten = self.db.execute(
+                "UPDATE tiles SET state = 'pending' WHERE state = 'done';"
+                ).rowcount
+            self.db.commit()
+            return forgotten
+
+    def state(self, zoom, x, y):
+        """The state of a tile, or None if it has not been recorded"""
+        with self.lock:
+            row = self.db.execute(
+                'SELECT state FROM tiles WHERE zoom_level = ? AND '
+                'tile_column = ? AND tile_row = ?;',
+                (int(zoom), int(x), int(y))).fetchone()
+            return row[0] if row else None
+
+    def add_tiles(self, tiles, batch_size = 1000):
+        """Record (zoom, x, y, ...) tile records as pending while passing
+           them on. If an earlier run stopped part way through enumeration,
+           tiles it already finished are not passed on again."""
+        with self.lock:
+            resuming = self.db.execute(
+                'SELECT 1 FROM tiles LIMIT 1;').fetchone() is not None
+        batch = []
+        for tile in tiles:
+            (zoom, x, y) = (int(tile[0]), int(tile[1]), int(tile[2]))
+            if resuming and self.state(zoom, x, y) not in (None,) + UNFINISHED:
+                continue
+            batch.append((zoom, x, y))
+            if len(batch) >= batch_size:
+                self._insert_pending(batch)
+                batch = []
+            yield tile
+        self._insert_pending(batch)
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO job (name, value) "
+                            "VALUES ('enumerated', '1');")
+            self.db.commit()
+
+    def _insert_pending(self, batch):
+        with self.lock:
+            self.db.executemany(
+                "INSERT OR IGNORE INTO tiles (zoom_level, tile_column, "
+                "tile_row, state) VALUES (?, ?, ?, 'pending');", batch)
+            self.db.commit()
+
+    def pending_tiles(self, batch_size = 1000):
+        """Yield (zoom, x, y) of every pending or failed tile, reading the
+           journal a batch at a time"""
+        last = (-1, -1, -1)
+        while True:
+            with self.lock:
+                rows = self.db.execute(
+                    'SELECT zoom_level, tile_column, tile_row FROM tiles '
+                    'WHERE state IN (?, ?) AND '
+                    '(zoom_level, tile_column, tile_row) > (?, ?, ?) '
+                    'ORDER BY zoom_level, tile_column, tile_row LIMIT ?;',
+                    UNFINISHED + last + (batch_size,)).fetchall()
+            if not rows:
+                return
+            yield from rows
+            last = tuple(rows[-1])
+
+    def done_tiles(self, batch_size = 1000):
+        """Yield (zoom, x, y) of every tile downloaded and stored, reading
+           the journal a batch at a time"""
+        last = (-1, -1, -1)
+        while True:
+            with self.lock:
+                self.flush()
+                rows = self.db.execute(
+                    "SELECT zoom_level, tile_column, tile_row FROM tiles "
+                    "WHERE state = 'done' AND "
+                    "(zoom_level, tile_column, tile_row) > (?, ?, ?) "
+                    "ORDER BY zoom_level, tile_column, tile_row LIMIT ?;",
+                    last + (batch_size,)).fetchall()
+            if not rows:
+                return
+            yield from rows
+            last = tuple(rows[-1])
+
+    def record(self, tile, state, reason = None):
+        """Record the new state of a (zoom, x, y, ...) tile. Updates are
+           saved in batches, so a crash loses at most a few seconds' work."""
+        with self.lock:
+            self.updates.append((int(tile[0]), int(tile[1]), int(tile[2]),
+                                 state, reason))
+            if (len(self.updates) >= self.batch_size or
+                time.time() - self.last_flush > self.flush_interval):
+                self.flush()
+
+    def record_all(self, tiles, state):
+        """Record the same new state for a list of (zoom, x, y, ...) tiles"""
+        with self.lock:
+            for tile in tiles:
+                self.record(tile, state)
+
+    def flush(self):
+        """Save any recorded updates to disk"""
+        with self.lock:
+            if self.updates:
+                self.db.executemany(
+                    'INSERT OR REPLACE INTO tiles (zoom_level, tile_column, '
+                    'tile_row, state, reason) VALUES (?, ?, ?, ?, ?);',
+                    self.updates)
+                self.db.commit()
+                self.updates = []
+            self.last_flush = time.time()
+
+    def close(self):
+        with self.lock:
+            self.flush()
+            self.db.close()
@@ -0,0 +1,108 @@
+#!/usr/bin/python3
+"""
+Tile math on whole arrays of tiles at once, using NumPy.
+
+The functions in utils and geo_utils work on one tile at a time, which is
+fine for a handful of tiles but means millions of Python-level math calls
+for a big Area of Interest. These take arrays (or lists, or single numbers)
+of x, y and zoom, and return arrays.
+
+x and y are Slippy Map tile addresses, with y counting down from the top,
+unless stated otherwise.
+"""
+import sys, os
+import numpy as np
+
+def as_arrays(*values):
+    """Integer arrays of the values, broadcast to the same shape"""
+    return np.broadcast_arrays(*[np.asarray(value, dtype = np.int64)
+                                 for value in values])
+
+def lat_lon_to_tiles(lat, lon, zoom):
+    """Returns arrays (x, y) of the tiles containing lat-long points.
+       Same as utils.lat_long_zoom_to_pixel_coords followed by
+       utils.pixel_coords_to_tile_address."""
+    lat = np.asarray(lat, dtype = np.float64)
+    lon = np.asarray(lon, dtype = np.float64)
+    mapsize = 256 * np.power(2.0, np.asarray(zoom, dtype = np.float64))
+    sinlat = np.sin(lat * np.pi / 180.0)
+    pixelx = np.floor(((lon + 180) / 360) * mapsize).astype(np.int64)
+    pixely = np.floor((0.5 - np.log((1 + sinlat) / (1 - sinlat))
+                       / (4 * np.pi)) * mapsize).astype(np.int64)
+    return (pixelx // 256, pixely // 256)
+
+def flip_y(y, zoom):
+    """Flip tile rows between Slippy Map (from the top) and TMS (from the
+       bottom, as in MBTiles). The same function goes either way."""
+    (y, zoom) = as_arrays(y, zoom)
+    return (np.int64(1) << zoom) - y - 1
+
+def tile_bounds(x, y, zoom):
+    """Returns arrays (left, bottom, right, top) of the edges of tiles in
+       degrees of longitude and latitude"""
+    (x, y, zoom) = as_arrays(x, y, zoom)
+    n = np.power(2.0, zoom)
+    left = x / n * 360 - 180
+    right = (x + 1) / n * 360 - 180
+    top = np.degrees(np.arctan(np.sinh(np.pi * (1 - 2 * y / n))))
+    bottom = np.degrees(np.arctan(np.sinh(np.pi * (1 - 2 * (y + 1) / n))))
+    return (left, bottom, right, top)
+
+def tiles_extent(x, y, zoom):
+    """Returns ((left, bottom, right, top), minzoom, maxzoom) covering all
+       the tiles, or None if there are none"""
+    (x, y, zoom) = as_arrays(x, y, zoom)
+    if not x.size:
+        return None
+    (left, bottom, right, top) = tile_bounds(x, y, zoom)
+    return ((float(left.min()), float(bottom.min()),
+             float(right.max()), float(top.max())),
+            int(zoom.min()), int(zoom.max()))
+
+def zoom_ranges(x, y, zoom):
+    """Returns {zoom: (min x, max x, min y, max y)} of the tiles at each
+       zoom level"""
+    (x, y, zoom) = as_arrays(x, y, zoom)
+    ranges = {}
+    for z in np.unique(zoom):
+        at_zoom = zoom == z
+        (xs, ys) = (x[at_zoom], y[at_zoom])
+        ranges[int(z)] = (int(xs.min()), int(xs.max()),
+                          int(ys.min()), int(ys.max()))
+    return ranges
+
+def quadkeys(x, y, zoom):
+    """Returns an array of the quadkeys of tiles (for Bing-style
+       tileservers), as utils.tile_coords_to_quadkey"""
+    (x, y, zoom) = [a.ravel() for a in as_arrays(x, y, zoom)]
+    maxzoom = int(zoom.max()) if zoom.size else 0
+    if maxzoom == 0:
+        return np.full(zoom.shape, '', dtype = 'U1')
+    # One column per digit, most significant first; the bit a digit comes
+    # from depends on the zoom of each tile, and shorter keys end early
+    bits = zoom[:, None] - 1 - np.arange(maxzoom)[None, :]
+    valid = bits >= 0
+    bits = np.where(valid, bits, 0)
+    digits = ((x[:, None] >> bits) & 1) + 2 * ((y[:, None] >> bits) & 1)
+    chars = np.where(valid, digits + ord('0'), 0).astype(np.uint8)
+    return chars.view('S{}'.format(maxzoom)).ravel().astype(str)
+
+def expand_runs(rows):
+    """Returns arrays (x, y) of every tile in {y: [(first x, last x), ...]}
+       runs of tiles, ordered by row and then column"""
+    firsts = []
+    lasts = []
+    ys = []
+    for y in sorted(rows):
+        for (first, last) in sorted(rows[y]):
+            firsts.append(first)
+            lasts.append(last)
+            ys.append(y)
+    if not ys:
+        return (np.zeros(0, dtype = np.int64), np.zeros(0, dtype = np.int64))
+    (firsts, lasts, ys) = as_arrays(firsts, lasts, ys)
+    lengths = lasts - firsts + 1
+    # Position of each tile within its run, added to the run's first x
+    starts = np.repeat(np.cumsum(lengths) - lengths, lengths)
+    x = np.repeat(firsts, lengths) + np.arange(lengths.sum()) - starts
+    return (x, np.repeat(ys, lengths))
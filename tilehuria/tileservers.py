@@ -0,0 +1,107 @@
+#!/usr/bin/python3
+"""
+The registry of known tileservers, read from URL_formats.txt once.
+
+Each line of URL_formats.txt is a tileserver name and a JOSM-style URL
+template, optionally followed by properties of the server as key=value:
+
+    maxzoom   highest zoom level the server has tiles for
+    tilesize  width of the tiles in pixels (default 256)
+    imtype    image type of the tiles: png or jpg (otherwise guessed from
+              the URL template)
+    rate      most requests per second to make to each of its hosts
+    burst     requests allowed at once before the rate applies
+    total_rate  most requests per second to make to the server as a whole,
+              across all of its hosts
+    blank     comma-separated SHA-1 hashes of the server's "no tile here"
+              placeholder tiles
+
+for example:
+
+    osm https://{switch:a,b,c}.tile.openstreetmap.org/{z}/{x}/{y}.png maxzoom=19
+
+Lines starting with # are comments.
+"""
+import sys, os
+import functools
+
+URL_FORMATS_FILE = os.path.join(os.path.dirname(__file__), 'URL_formats.txt')
+
+def guess_imtype(url_template):
+    """Guess the image type of a server's tiles from its URL template"""
+    imtype = 'png'
+    if('.jpeg' in url_template or '.jpg' in url_template):
+        imtype = 'jpg'
+    if('google' in url_template):  # Yes, a crude and brittle hack
+        imtype = 'jpg'
+    return imtype
+
+class TileServer:
+    """A tileserver: its name, URL template and properties"""
+
+    def __init__(self, name, url_template, maxzoom = None, tilesize = 256,
+                 imtype = None, rate = None, burst = None, total_rate = None,
+                 blank = ()):
+        self.name = name
+        self.url_template = url_template
+        self.maxzoom = int(maxzoom) if maxzoom is not None else None
+        self.tilesize = int(tilesize)
+        self.imtype = imtype or guess_imtype(url_template)
+        self.rate = float(rate) if rate else None
+        self.burst = int(burst) if burst else None
+        self.total_rate = float(total_rate) if total_rate else None
+        self.blank = frozenset(blank)
+
+    @classmethod
+    def from_line(cls, line):
+        """A TileServer from a line of URL_formats.txt, or None if the line
+           is not a tileserver"""
+        entry = line.split()
+        if len(entry) < 2 or entry[0].startswith('#'):
+            return None
+        properties = {}
+        for item in entry[2:]:
+            (key, sep, value) = item.partition('=')
+            if key == 'blank':
+                properties[key] = [h.lower() for h in value.split(',') if h]
+            elif sep:
+                properties[key] = value
+        return cls(entry[0], entry[1], **properties)
+
+class TileServerRegistry:
+    """All the tileservers in a URL formats file, by name"""
+
+    def __init__(self, urlfile = URL_FORMATS_FILE):
+        self.urlfile = urlfile
+        self.servers = {}
+        with open(urlfile) as f:
+            for line in f:
+                server = TileServer.from_line(line)
+                if server:
+                    self.servers[server.name] = server
+
+    def names(self):
+        return list(self.servers)
+
+    def get(self, name):
+        """The TileServer of a name, or None if there is none"""
+        return self.servers.get(name)
+
+@functools.lru_cache(maxsize = None)
+def get_registry(urlfile = URL_FORMATS_FILE):
+    """The registry for a URL formats file, read only the first time"""
+    return TileServerRegistry(urlfile)
+
+def get_tileserver(opts):
+    """The TileServer for the options: the tileserver named in them, or if
+       a URL template is given, a server made from the template (with the
+       properties of the named server if it has the same template)"""
+    try:
+        server = get_registry().get(opts.get('tileserver'))
+    except OSError:
+        server = None
+    url_template = opts.get('url_template')
+    if url_template and (server is None or
+                         server.url_template != url_template):
+        return TileServer('from_url', url_template)
+    return server
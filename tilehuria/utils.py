@@ -7,7 +7,10 @@ import argparse
 
 import math
 import re
-import random
+import functools
+import itertools
+
+from tileservers import get_registry, URL_FORMATS_FILE
 
 def lat_long_zoom_to_pixel_coords(lat, lon, zoom):
     """Create pixel coordinates from lat-long point at a given zoom level"""
@@ -23,33 +26,114 @@ def pixel_coords_to_tile_address(x,y):
     y = int(math.floor(y / 256))
     return (x, y)
 
+# The JOSM-style placeholders understood in URL templates
+URL_PLACEHOLDER = re.compile(
+    r"\{(switch:[^}]*|x|y|-y|!y|quadkey|(?:z|zoom)(?:[+-]\d+)?)\}")
+
+class UrlTemplate:
+    """A URL template parsed once, to make the URLs of any number of tiles.
+
+       Understands the JOSM placeholders {x}, {y}, {z} or {zoom} (with an
+       optional offset, as in {zoom+1}), {-y} (TMS rows, counted from the
+       bottom), {!y} (OSGeo TMS rows), {quadkey} (Bing-style) and
+       {switch:a,b,c}. Switches take turns round-robin through their
+       choices, to spread the load evenly across mirror servers."""
+
+    def __init__(self, template):
+        self.template = template
+        # Strip prefixes from urls (JOSM-style urls contain tms information in prefix)
+        template = re.sub(r".*https\:\/\/", 'https://', template)
+        template = re.sub(r".*http\:\/\/", 'http://', template)
+
+        # Turn the template into a format string with a numbered field per
+        # placeholder, and a function to work out the value of each field
+        self.getters = []
+        self.switches = {}   # field number: choices, for each {switch:}
+        pieces = []
+        patterns = []        # a regular expression matching its URLs
+        position = 0
+        for match in URL_PLACEHOLDER.finditer(template):
+            literal = template[position:match.start()]
+            pieces.append(literal.replace('{', '{{').replace('}', '}}'))
+            pieces.append('{{{}}}'.format(len(self.getters)))
+            patterns.append(re.escape(literal))
+            if match.group(1).startswith('switch:'):
+                self.switches[len(self.getters)] = switch_choices(
+                    match.group(1))
+                patterns.append('(?:{})'.format('|'.join(
+                    re.escape(choice) for choice in
+                    self.switches[len(self.getters)])))
+            else:
+                patterns.append('-?[0-9]+')
+            self.getters.append(self.getter(match.group(1)))
+            position = match.end()
+        literal = template[position:]
+        pieces.append(literal.replace('{', '{{').replace('}', '}}'))
+        patterns.append(re.escape(literal))
+        self.format_string = ''.join(pieces)
+        self.pattern = re.compile(''.join(patterns) + '$')
+
+    @staticmethod
+    def getter(placeholder):
+        """A function of (tileX, tileY, zoom) for the value of a placeholder"""
+        if placeholder.startswith('switch:'):
+            choice = itertools.cycle(switch_choices(placeholder))
+            return lambda tileX, tileY, zoom: next(choice)
+        if placeholder == 'x':
+            return lambda tileX, tileY, zoom: tileX
+        if placeholder == 'y':
+            return lambda tileX, tileY, zoom: tileY
+        if placeholder == '-y':
+            return lambda tileX, tileY, zoom: (1 << zoom) - 1 - tileY
+        if placeholder == '!y':
+            return lambda tileX, tileY, zoom: ((1 << zoom) >> 1) - 1 - tileY
+        if placeholder == 'quadkey':
+            return tile_coords_to_quadkey
+        offset = int(re.sub(r'^(zoom|z)', '', placeholder) or 0)
+        return lambda tileX, tileY, zoom: zoom + offset
+
+    def url(self, tileX, tileY, zoom):
+        """The URL of a tile"""
+        return self.format_string.format(*[get(tileX, tileY, zoom)
+                                           for get in self.getters])
+
+    def matches(self, url):
+        """True if a URL could have been made from this template"""
+        return self.pattern.match(url) is not None
+
+    def mirror_urls(self, tileX, tileY, zoom):
+        """The URLs of a tile on every combination of the {switch:} choices"""
+        values = [None if field in self.switches else get(tileX, tileY, zoom)
+                  for (field, get) in enumerate(self.getters)]
+        fields = sorted(self.switches)
+        urls = []
+        for combination in itertools.product(*[self.switches[field]
+                                               for field in fields]):
+            for (field, choice) in zip(fields, combination):
+                values[field] = choice
+            urls.append(self.format_string.format(*values))
+        return urls
+
+def switch_choices(placeholder):
+    """The choices of a {switch:a,b,c} placeholder"""
+    return [choice.strip() for choice in
+            placeholder[len('switch:'):].split(',')]
+
+@functools.lru_cache(maxsize = 16)
+def compile_url_template(url_template):
+    """The UrlTemplate for a template string, parsed only the first time"""
+    return UrlTemplate(url_template)
+
 def tile_coords_to_url(tileX, tileY, zoom, url_template):
     """Create a URL for a tile based on XYZ coordinates and a template URL"""
-    url = ''
-    # Random server switching based on choices embedded in the template URL
-    switchre = r"\{switch:(.*?)\}"
-    matches = re.finditer(switchre, url_template, re.MULTILINE | re.DOTALL)
-    switchedchoice = ''
-    for match in matches:
-        contents = match.group(1)
-        switchedchoice = random.choice(contents.split(',')).strip()
-    url = re.sub(switchre, switchedchoice, url_template)        
-
-    # Replace {x}, {y}, and {z} placeholders with the correct values
-    url = re.sub(r"\{x\}", str(tileX), url)
-    url = re.sub(r"\{y\}", str(tileY), url)
-    totalrowsatthiszoomlevel = int(math.pow(2, zoom)) 
-    url = re.sub(r"\{-y\}", str((totalrowsatthiszoomlevel - 1) - tileY), url)
-    url = re.sub(r"\{z\}|\{zoom\}", str(zoom), url)
-
-    # replace {quadkey} with the actual item
-    url = re.sub(r"\{quadkey\}", tile_coords_to_quadkey(tileX, tileY, zoom), url)
-                 
-    # Strip prefixes from urls (JOSM-style urls contain tms information in prefix)
-    url = re.sub(r".*https\:\/\/", 'https://', url)
-    url = re.sub(r".*http\:\/\/", 'http://', url)
-    
-    return url
+    return compile_url_template(url_template).url(tileX, tileY, zoom)
+
+def tiles_with_urls(tiles, url_template):
+    """Yield (zoom, x, y, url) for each (zoom, x, y) tile record"""
+    template = compile_url_template(url_template)
+    for (zoom, tileX, tileY) in tiles:
+        yield (zoom, tileX, tileY,
+               template.url(int(tileX), int(tileY), int(zoom)))
 
 def tile_coords_to_quadkey(x, y, zoom):
     """Create a quadkey from xyzoom coordinates for Bing-style tileservers."""
@@ -64,38 +148,28 @@ def tile_coords_to_quadkey(x, y, zoom):
         quadKey += str(digit)
     return quadKey
 
-def url_template_from_file(tsname,
-                           urlfile = (os.path.join
-                           (os.path.dirname(__file__), 'URL_formats.txt'))):
+def url_template_from_file(tsname, urlfile = URL_FORMATS_FILE):
     """Provide a url template from specified file or default URL_formats.txt
        in the same directory as this module"""
-    d = {}
     try:
-        with open(urlfile) as urlfile:
-            d = {}
-            for line in urlfile:
-                entry = line.strip().split(None, 1)
-                if len(entry) == 2:
-                    d[entry[0]] = entry[1]
-                
+        registry = get_registry(urlfile)
     except Exception as e:
         print('Did not manage to find or open {}'.format(urlfile))
         print(e)
         exit(1)
 
-    if tsname in d:
-        return d[tsname]
+    server = registry.get(tsname)
+    if server:
+        return server.url_template
     else:
         print('No URL template for {} found in {}'.format(tsname, urlfile))
         return None
 
-def get_url_name_list(urlfile = (os.path.join
-                                 (os.path.dirname(__file__),
-                                  'URL_formats.txt'))):
-    servernames = []
-    with open(urlfile) as urlfile:
-        for line in urlfile:
-            entry = line.strip().split(None, 1)
-            if len(entry) == 2:
-                servernames.append(entry[0])
-    return servernames
+def get_url_template(opts):
+    """The URL template given in the options, or else the one on file
+       for the tileserver given in the options"""
+    return (opts['url_template'] if opts['url_template']
+            else url_template_from_file(opts['tileserver']))
+
+def get_url_name_list(urlfile = URL_FORMATS_FILE):
+    return get_registry(urlfile).names()
@@ -0,0 +1,187 @@
+#!/usr/bin/python3
+"""
+A shared queue of tiles for download workers, and statistics per worker.
+
+Rather than giving each thread a fixed slice of the tile list up front (so
+that one thread stuck on a slow mirror holds up the whole job while the
+rest sit idle), every worker pulls the next tile from the shared queue as
+soon as it finishes the last one.
+
+Tiles that fail go back into the queue to be retried after an exponential
+backoff with random jitter, up to a maximum number of attempts. Only the
+failed tiles are retried, and the reason for each failure is kept.
+"""
+import sys, os
+import heapq
+import random
+import threading
+import time
+from array import array
+
+from http_pool import describe_failure
+
+def attempt_timeout(attempt):
+    """Seconds to wait for a server to respond: 10 on the first attempt,
+       and a patient 100 when trying a tile again"""
+    return 10 if attempt == 1 else 100
+
+class TileQueue:
+    """Hands out tiles from any iterable, one at a time, to many workers,
+       along with failed tiles which are due for another attempt"""
+
+    def __init__(self, tiles, max_attempts = 3, backoff = 1.0,
+                 max_backoff = 60.0, journal = None):
+        self.tiles = iter(tiles)
+        self.journal = journal  # a TileJournal to record outcomes in
+        self.max_attempts = max(1, int(max_attempts))
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.exhausted = False
+        self.retries = []     # heap of (due time, sequence, tile, attempt)
+        self.sequence = 0
+        self.in_flight = 0
+        self.total = 0        # tiles taken from the iterable so far
+        self.succeeded = 0
+        self.empty = 0        # succeeded, but there was no tile there
+        self.unchanged = 0    # succeeded, the server said it had not changed
+        self.retried = 0
+        self.failures = {}    # tile: reason, for tiles that were given up on
+        self.stopped = None   # why the job was stopped, if it was
+        # Without a journal to look them up in, the (zoom, x, y) of the
+        # tiles stored, one after another in a compact array
+        self.stored = array('q')
+        self.condition = threading.Condition()
+
+    def backoff_delay(self, attempt):
+        """Seconds to wait before the next attempt: exponential, capped,
+           with full jitter so retries do not arrive in lockstep"""
+        cap = min(self.max_backoff, self.backoff * 2 ** (attempt - 1))
+        return random.uniform(0, cap)
+
+    def poll(self):
+        """Without blocking, returns one of
+           ('tile', (tile, attempt))  a tile to download, now in flight
+           ('wait', seconds)          nothing yet; seconds is None if only
+                                      a tile in flight could bring more work
+           ('done', None)             every tile has succeeded or failed"""
+        with self.condition:
+            now = time.monotonic()
+            if self.retries and self.retries[0][0] <= now:
+                (due, sequence, tile, attempt) = heapq.heappop(self.retries)
+                self.in_flight += 1
+                return ('tile', (tile, attempt))
+            if not self.exhausted:
+                tile = next(self.tiles, None)
+                if tile is not None:
+                    self.total += 1
+                    self.in_flight += 1
+                    return ('tile', (tile, 1))
+                self.exhausted = True
+            if self.retries:
+                return ('wait', self.retries[0][0] - now)
+            if self.in_flight:
+                return ('wait', None)
+            return ('done', None)
+
+    def stored_tiles(self):
+        """Yield the (zoom, x, y) of the tiles stored, if there is no
+           journal to look them up in"""
+        for i in range(0, len(self.stored), 3):
+            yield tuple(self.stored[i:i + 3])
+
+    def stop(self, reason):
+        """Hand out no more tiles, for instance because there is nowhere
+           to store them. The tiles in flight are left to finish."""
+        with self.condition:
+            if self.stopped is None:
+                print('\nStopping: {}'.format(reason))
+                self.stopped = reason
+            self.exhausted = True
+            self.retries = []
+            self.condition.notify_all()
+
+    def get(self):
+        """Blocks until there is a (tile, attempt) to download, or returns
+           None when there is no more work"""
+        with self.condition:
+            while True:
+                (state, value) = self.poll()
+                if state == 'tile':
+                    return value
+                if state == 'done':
+                    return None
+                self.condition.wait(value)
+
+    def done(self, tile, attempt, reason = None, retry = True,
+             state = 'done'):
+        """Report a tile finished. If it failed (a reason is given), queue
+           it for another attempt unless retry is False or it is out of
+           attempts, in which case keep the reason it failed. The state of
+           a successful tile (done, empty or unchanged) goes in the
+           journal. A tile which is 'queued' to be stored elsewhere is
+           recorded in the journal by whatever stores it, once it has."""
+        with self.condition:
+            self.in_flight -= 1
+            if reason is None:
+                self.succeeded += 1
+                if state == 'empty':
+                    self.empty += 1
+                elif state == 'unchanged':
+                    self.unchanged += 1
+                if self.journal and state != 'queued':
+                    self.journal.record(tile, state)
+                elif not self.journal and state == 'done':
+                    self.stored.extend(int(n) for n in tile[:3])
+            elif retry and attempt < self.max_attempts and not self.stopped:
+                due = time.monotonic() + self.backoff_delay(attempt)
+                self.sequence += 1
+                heapq.heappush(self.retries,
+                               (due, self.sequence, tile, attempt + 1))
+                self.retried += 1
+            else:
+                self.failures[tile] = reason
+                if self.journal:
+                    self.journal.record(tile, 'failed', reason)
+            self.condition.notify_all()
+
+def store_or_stop(tilequeue, store, z, x, y, url, response):
+    """Store a downloaded tile with store(z, x, y, url, rawdata, headers),
+       returning its state. With no response, the server has no tile
+       there, and store gets None. If it cannot be stored, there is no
+       point downloading any more, so the TileQueue is stopped."""
+    try:
+        if response is None:
+            return store(z, x, y, url, None, {})
+        return store(z, x, y, url, response.data, response.headers)
+    except Exception as e:
+        tilequeue.stop('could not store tile {}/{}/{}: {}'
+                       .format(z, x, y, describe_failure(e)))
+        raise
+
+def new_worker_stats(name):
+    """A dict for a worker to count its tiles, bytes, errors and time"""
+    return {'name': name, 'tiles': 0, 'bytes': 0, 'errors': 0,
+            'started': time.time(), 'finished': None}
+
+def worker_rate(stats):
+    """Tiles per second downloaded by a worker"""
+    elapsed = (stats['finished'] or time.time()) - stats['started']
+    return stats['tiles'] / elapsed if elapsed > 0 else 0.0
+
+def report_worker_stats(all_stats, verbose = False):
+    """Print the spread of download rates across workers, and how long the
+       first worker to finish sat waiting for the last"""
+    if not all_stats:
+        return
+    rates = sorted(worker_rate(stats) for stats in all_stats)
+    finishes = [stats['finished'] for stats in all_stats if stats['finished']]
+    tail = max(finishes) - min(finishes) if finishes else 0.0
+    print('{} workers: {:.1f} to {:.1f} tiles/s each (median {:.1f}); '
+          'the last finished {:.2f} seconds after the first'
+          .format(len(rates), rates[0], rates[-1], rates[len(rates) // 2],
+                  tail))
+    if verbose:
+        for stats in all_stats:
+            print('  {}: {} tiles, {} bytes, {} errors, {:.1f} tiles/s'
+                  .format(stats['name'], stats['tiles'], stats['bytes'],
+                          stats['errors'], worker_rate(stats)))
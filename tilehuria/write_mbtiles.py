@@ -12,9 +12,15 @@ import sqlite3
 import argparse
 import math
 import re
+import queue
+import threading
+import hashlib
+import time
 
 sys.path.insert(0, os.path.dirname(__file__))
 from arguments import argumentlist, set_defaults
+from tile_math import as_arrays, flip_y, tiles_extent, zoom_ranges
+from metrics import Metrics
 
 def scandir(dir):
     """Walk recursively through a directory and return a list of all files in it"""
@@ -47,56 +53,12 @@ def increment_bounds(zoom, x, y, left, bottom, right, top):
     top = newtop if newtop > top else top
     return(left, bottom, right, top)
 
-def write_mbtiles(tiledir, optsin = {}):
-    """Take a folder of tiles in Slippy Map-style schema, return an MBtiles file."""
-    opts = set_defaults(optsin)
-    outfile = tiledir + '.mbtiles'
-    if os.path.exists(outfile):
-        os.remove(outfile)
-    sqlite_file = outfile
-    db = sqlite3.connect(sqlite_file)
-    cursor = db.cursor()
-
-    cursor.execute('''
-    CREATE TABLE tiles (zoom_level INTEGER, tile_column INTEGER, 
-                        tile_row INTEGER, tile_data BLOB);''')
-    cursor.execute('''
-    CREATE UNIQUE INDEX tile_index on tiles (zoom_level, tile_column, tile_row);''')    
-    image_files = scandir(tiledir)
-    image_file_type = ''
-    maxz = 0  # Max zoom will be incremented when we actually find tiles
-    minz = 23  # As above but decrementing
-    # Set initial bounds at opposite sides of their global extents
-    (left, bottom, right, top) = (180.0, 85.05113, -180.0, -85.05113)
-    (centerlon, centerlat) = ('','')
-    for image_file in image_files:
-        (image_filename, image_ext) = os.path.splitext(image_file)
-        # Don't add the file to the tileset if it's not an image
-        if(image_ext == '.png' or image_ext == '.jpeg' or image_ext == '.jpg'):
-            # Save a string with the filetype (extension) for use in metadata table
-            #TODO: check if there are multiple file types and throw an error if so
-            image_file_type = image_ext.replace('.','')
-            image_blob = open(image_file, "rb").read()
-            (z, x, tiley) = path_to_zxy(image_filename)
-            # MBTiles spec Y is upside down - subtract the tile y from max tile y
-            y = int(math.pow(2.0, float(z)) - float(tiley) - 1.0)
-            cursor.execute('''
-            INSERT INTO tiles (zoom_level, tile_column, tile_row, tile_data) 
-                               VALUES(?,?,?,?)
-            ''',(z,x,y,sqlite3.Binary(image_blob)))
-            db.commit()
-
-            # Update min and max zoom levels and bounds for use in metadata table
-            maxz = z if int(z) > int(maxz) else maxz  # Will end at correct max zoom
-            minz = z if int(z) < int(minz) else minz  # As above for min zoom
-            (left, bottom, right, top) = increment_bounds(z, x, tiley,
-                                                          left, bottom,
-                                                          right, top)
-            centerlon = float(right) - float(left)
-            centerlat = float(top) - float(bottom)
-    
-    cursor.execute('CREATE TABLE metadata (name TEXT, value TEXT);')
-    tilesetmetadata = [('name', tiledir),
+def write_metadata(cursor, name, opts, image_file_type, bounds, minz, maxz):
+    """Create and fill the metadata table of an MBTiles file"""
+    (left, bottom, right, top) = bounds
+    cursor.execute('CREATE TABLE IF NOT EXISTS metadata (name TEXT, value TEXT);')
+    cursor.execute('DELETE FROM metadata;')
+    tilesetmetadata = [('name', name),
                        ('type', opts['type']),
                        ('description', opts['description']),
                        ('attribution', opts['attribution']),
@@ -109,8 +71,470 @@ def write_mbtiles(tiledir, optsin = {}):
                        ('maxzoom', maxz)]
     cursor.executemany(
         '''INSERT INTO metadata (name, value) VALUES(?,?)''',tilesetmetadata)
-    db.commit()
+
+def merge_ranges(ranges, more):
+    """Combine two {zoom: (min x, max x, min y, max y)} dicts of ranges"""
+    merged = dict(ranges)
+    for (z, (xmin, xmax, ymin, ymax)) in more.items():
+        if z in merged:
+            (oxmin, oxmax, oymin, oymax) = merged[z]
+            (xmin, xmax) = (min(xmin, oxmin), max(xmax, oxmax))
+            (ymin, ymax) = (min(ymin, oymin), max(ymax, oymax))
+        merged[z] = (xmin, xmax, ymin, ymax)
+    return merged
+
+def missing_tiles(tiles, mbtilesfile):
+    """Pass on only those (zoom, x, y, ...) tile records which are not
+       already in an MBTiles file"""
+    if not os.path.exists(mbtilesfile):
+        yield from tiles
+        return
+    db = sqlite3.connect(mbtilesfile, check_same_thread = False)
+    skipped = 0
+    for tile in tiles:
+        (z, x, y) = (int(tile[0]), int(tile[1]), int(tile[2]))
+        if db.execute('SELECT 1 FROM tiles WHERE zoom_level = ? AND '
+                      'tile_column = ? AND tile_row = ?;',
+                      (z, x, 2 ** z - y - 1)).fetchone():
+            skipped += 1
+            continue
+        yield tile
     db.close()
+    print('Skipped {} tiles already in {}'.format(skipped, mbtilesfile))
+
+class TileValidators:
+    """The ETag and Last-Modified date recorded for each tile in an MBTiles
+       file, to ask the server for a tile only if it has changed. Safe to
+       share between threads."""
+
+    def __init__(self, mbtilesfile):
+        self.db = sqlite3.connect(mbtilesfile, check_same_thread = False,
+                                  timeout = 30)
+        self.lock = threading.Lock()
+        try:
+            self.count = self.db.execute(
+                'SELECT COUNT(*) FROM tile_validators;').fetchone()[0]
+        except sqlite3.OperationalError:   # made before they were recorded
+            self.count = 0
+
+    def headers(self, z, x, y):
+        """Headers making a request for a tile conditional on it having
+           changed, or none if nothing is known about it"""
+        if not self.count:
+            return {}
+        (z, x, y) = (int(z), int(x), int(y))
+        with self.lock:
+            row = self.db.execute(
+                'SELECT etag, last_modified FROM tile_validators WHERE '
+                'zoom_level = ? AND tile_column = ? AND tile_row = ?;',
+                (z, x, 2 ** z - y - 1)).fetchone()
+        headers = {}
+        if row and row[0]:
+            headers['If-None-Match'] = row[0]
+        if row and row[1]:
+            headers['If-Modified-Since'] = row[1]
+        return headers
+
+    def close(self):
+        self.db.close()
+
+class MBTilesWriter:
+    """Write tiles straight into an MBTiles file, from any number of threads.
+       Tiles are handed through a queue to a single writer thread, which
+       inserts them in batches of batch_size, or of however many have come
+       in flush_interval seconds, when they come slowly. Call close() to
+       finish the file.
+
+       A new file is bulk loaded: it is built under a temporary name with
+       journaling and fsync turned off, in a single transaction, with the
+       index created after all the tiles are in, and only renamed to its
+       real name once it is complete. With append, tiles are added to an
+       existing file (if there is one) in ordinary committed batches.
+
+       With the dedupe option, each distinct tile image is stored only once,
+       in an images table keyed by its hash, with a map table pointing every
+       tile at its image and a tiles view over the two for readers. Images
+       no tile points at any more, once tiles are replaced, are deleted.
+
+       The ETag and Last-Modified headers a tile was downloaded with, if
+       any, are kept in a tile_validators table, for TileValidators.
+
+       committed, if given, is called with a list of the (zoom, x, y) of
+       the tiles of each batch and 'done' once they are safely in the file
+       (or 'empty', for the tiles removed from it); every batch is then
+       committed, even when bulk loading. With resume, an interrupted bulk
+       load like this is carried on with rather than thrown away: its tiles
+       are the ones the caller was told were committed. Only the caller
+       knows the temporary file is from the same job, so any other one
+       left behind is deleted.
+       If writing fails (a full disk, say), the error is raised by the
+       next add() and by close(). The time spent writing is added to the
+       write stage of metrics, if given."""
+
+    def __init__(self, outfile, optsin = {}, append = False, batch_size = 1000,
+                 committed = None, metrics = None, resume = False,
+                 flush_interval = 5.0):
+        self.opts = set_defaults(optsin)
+        self.outfile = outfile
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.committed = committed
+        self.metrics = metrics or Metrics()
+        self.error = None  # the exception that stopped the writer thread
+        self.image_file_types = {}  # extension: number of tiles
+        self.count = 0
+        self.removed = 0  # tiles taken out of the file
+        self.ranges = {}  # zoom: (min x, max x, min y, max y) added
+        # An interrupted bulk load of committed batches, to carry on with
+        self.resumed = bool(resume and committed and
+                            os.path.exists(outfile + '.tmp'))
+        self.bulk = self.resumed or not (append and os.path.exists(outfile))
+        self.dedupe = bool(self.opts['dedupe'])
+        self.tile_ids = set()  # hashes of the images already in the file
+        self.path = outfile + '.tmp' if self.bulk else outfile
+        if not self.resumed and os.path.exists(outfile + '.tmp'):
+            # Left behind by an interrupted run, which must not take the
+            # place of the file when this one is done
+            os.remove(outfile + '.tmp')
+        self.db = sqlite3.connect(self.path, check_same_thread = False)
+        cursor = self.db.cursor()
+        if self.bulk and self.committed:
+            # The tiles committed must survive a crash, to be resumed from
+            cursor.execute('PRAGMA journal_mode=WAL;')
+            cursor.execute('PRAGMA synchronous=NORMAL;')
+            cursor.execute('PRAGMA cache_size=-65536;')  # 64MB
+        elif self.bulk:
+            # Safe, as a crash leaves only the temporary file behind
+            cursor.execute('PRAGMA journal_mode=OFF;')
+            cursor.execute('PRAGMA synchronous=OFF;')
+            cursor.execute('PRAGMA cache_size=-65536;')  # 64MB
+        if self.resumed or not self.bulk:
+            # An existing file keeps whichever layout it was made with
+            existing = cursor.execute(
+                "SELECT type FROM sqlite_master WHERE name = 'tiles';").fetchone()
+            if existing:
+                self.dedupe = existing[0] == 'view'
+        if self.dedupe:
+            cursor.execute('''
+            CREATE TABLE IF NOT EXISTS map (zoom_level INTEGER,
+                tile_column INTEGER, tile_row INTEGER, tile_id TEXT);''')
+            cursor.execute('''
+            CREATE TABLE IF NOT EXISTS images (tile_data BLOB, tile_id TEXT);''')
+            cursor.execute('''
+            CREATE VIEW IF NOT EXISTS tiles AS SELECT map.zoom_level AS zoom_level,
+                map.tile_column AS tile_column, map.tile_row AS tile_row,
+                images.tile_data AS tile_data
+                FROM map JOIN images ON images.tile_id = map.tile_id;''')
+            self.tile_ids = set(row[0] for row in
+                                cursor.execute('SELECT tile_id FROM images;'))
+        else:
+            cursor.execute('''
+            CREATE TABLE IF NOT EXISTS tiles (zoom_level INTEGER, tile_column INTEGER, 
+                                tile_row INTEGER, tile_data BLOB);''')
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS tile_validators (zoom_level INTEGER,
+            tile_column INTEGER, tile_row INTEGER, etag TEXT,
+            last_modified TEXT,
+            PRIMARY KEY (zoom_level, tile_column, tile_row)) WITHOUT ROWID;''')
+        if not self.bulk:
+            self.create_index()
+        self.db.commit()
+        self.queue = queue.Queue(maxsize = batch_size * 10)
+        self.thread = threading.Thread(target = self._run)
+        self.thread.start()
+
+    def add(self, z, x, y, data, image_file_type, etag = None,
+            last_modified = None):
+        """Queue a tile for writing. y counts from the top, Slippy Map-style.
+           etag and last_modified are the validators it was downloaded with."""
+        if self.error:
+            raise self.error
+        self.queue.put((int(z), int(x), int(y), sqlite3.Binary(data),
+                        image_file_type, etag, last_modified))
+
+    def remove(self, z, x, y):
+        """Queue a tile to be taken out of the file, where there is no
+           longer any imagery for it"""
+        if self.error:
+            raise self.error
+        self.queue.put((int(z), int(x), int(y), None, None, None, None))
+
+    def create_index(self):
+        """Create the unique index on tile coordinates. If a tile went in
+           twice (say as both .png and .jpeg), keep the last one."""
+        (table, name) = ('map', 'map_index') if self.dedupe else ('tiles', 'tile_index')
+        index = '''
+        CREATE UNIQUE INDEX IF NOT EXISTS {} on {} (zoom_level, tile_column, tile_row);'''.format(name, table)
+        exists = self.db.execute("SELECT 1 FROM sqlite_master WHERE "
+                                 "name = ?;", (name,)).fetchone()
+        if not exists:
+            # Delete the duplicates first, rather than after a failed
+            # CREATE INDEX, which cannot be undone with journaling off
+            self.db.execute('''
+            DELETE FROM {0} WHERE rowid NOT IN (SELECT MAX(rowid) FROM {0}
+                GROUP BY zoom_level, tile_column, tile_row);'''.format(table))
+        self.db.execute(index)
+        if self.dedupe:
+            self.db.execute('''
+            CREATE UNIQUE INDEX IF NOT EXISTS images_id on images (tile_id);''')
+            # To tell whether an image is still used by any tile
+            self.db.execute('''
+            CREATE INDEX IF NOT EXISTS map_tile_id on map (tile_id);''')
+            self.delete_unused_images()
+
+    def delete_unused_images(self, tile_ids = None):
+        """Delete the images no tile points at any more: of a set of
+           tile_ids, or else of all of them"""
+        if tile_ids is None:
+            tile_ids = [row[0] for row in self.db.execute('''
+            SELECT tile_id FROM images WHERE tile_id NOT IN
+                (SELECT tile_id FROM map);''')]
+        else:
+            tile_ids = [tile_id for tile_id in tile_ids if not
+                        self.db.execute('SELECT 1 FROM map WHERE tile_id = ? '
+                                        'LIMIT 1;', (tile_id,)).fetchone()]
+        self.db.executemany('DELETE FROM images WHERE tile_id = ?;',
+                            [(tile_id,) for tile_id in tile_ids])
+        self.tile_ids.difference_update(tile_ids)
+
+    def _insert_deduplicated(self, rows):
+        """Insert each new image once, and point every tile at its image.
+           Images only used by the tiles replaced are deleted."""
+        images = []
+        tiles = []
+        replaced = set()  # images of tiles already in the file
+        for (z, x, y, data) in rows:
+            tile_id = hashlib.md5(data).hexdigest()
+            if tile_id not in self.tile_ids:
+                self.tile_ids.add(tile_id)
+                images.append((data, tile_id))
+            tiles.append((z, x, y, tile_id))
+            if not self.bulk:
+                old = self.db.execute(
+                    'SELECT tile_id FROM map WHERE zoom_level = ? AND '
+                    'tile_column = ? AND tile_row = ?;', (z, x, y)).fetchone()
+                if old and old[0] != tile_id:
+                    replaced.add(old[0])
+        self.db.executemany('''
+        INSERT INTO images (tile_data, tile_id) VALUES(?,?)''', images)
+        self.db.executemany('''
+        INSERT OR REPLACE INTO map (zoom_level, tile_column, tile_row, tile_id)
+                           VALUES(?,?,?,?)''', tiles)
+        if replaced:
+            self.delete_unused_images(replaced)
+
+    def _insert(self, batch):
+        """Write a batch of tiles, and remove those queued for removal"""
+        tiles = [item for item in batch if item[3] is not None]
+        removed = [item[:3] for item in batch if item[3] is None]
+        if tiles:
+            self._insert_tiles(tiles)
+        if removed:
+            self._remove_tiles(removed)
+        if not self.bulk or self.committed:
+            self.db.commit()
+        if self.committed and tiles:
+            self.committed([item[:3] for item in tiles], 'done')
+        if self.committed and removed:
+            self.committed(removed, 'empty')
+
+    def _remove_tiles(self, tiles):
+        """Delete (zoom, x, y) tiles, and their validators, from the file"""
+        rows = [(z, x, 2 ** z - y - 1) for (z, x, y) in tiles]
+        where = 'WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?'
+        if self.dedupe:
+            old = set()
+            for row in rows:
+                old.update(tile_id for (tile_id,) in self.db.execute(
+                    'SELECT tile_id FROM map {};'.format(where), row))
+            self.db.executemany('DELETE FROM map {};'.format(where), rows)
+            self.delete_unused_images(old)
+        else:
+            self.db.executemany('DELETE FROM tiles {};'.format(where), rows)
+        self.db.executemany('DELETE FROM tile_validators {};'.format(where),
+                            rows)
+        self.removed += len(tiles)
+
+    def _insert_tiles(self, batch):
+        (zooms, tileXs, tileYs) = as_arrays([item[0] for item in batch],
+                                            [item[1] for item in batch],
+                                            [item[2] for item in batch])
+        # MBTiles spec Y is upside down - subtract the tile y from max tile y
+        rows = list(zip(zooms.tolist(), tileXs.tolist(),
+                        flip_y(tileYs, zooms).tolist(),
+                        [item[3] for item in batch]))
+        if self.dedupe:
+            self._insert_deduplicated(rows)
+        else:
+            self.db.executemany('''
+            INSERT OR REPLACE INTO tiles (zoom_level, tile_column, tile_row, tile_data) 
+                               VALUES(?,?,?,?)
+            ''', rows)
+        validated = [row[:3] + item[5:] for (row, item) in zip(rows, batch)
+                     if item[5] or item[6]]
+        if validated:
+            self.db.executemany('''
+            INSERT OR REPLACE INTO tile_validators VALUES(?,?,?,?,?)''',
+                                validated)
+        if not self.bulk:
+            if len(validated) < len(rows):
+                # A tile replaced without validators has none any more
+                self.db.executemany('''
+                DELETE FROM tile_validators WHERE zoom_level = ? AND
+                    tile_column = ? AND tile_row = ?''',
+                    [row[:3] for (row, item) in zip(rows, batch)
+                     if not (item[5] or item[6])])
+        for item in batch:
+            self.image_file_types[item[4]] = (
+                self.image_file_types.get(item[4], 0) + 1)
+        self.ranges = merge_ranges(self.ranges,
+                                   zoom_ranges(tileXs, tileYs, zooms))
+        self.count += len(batch)
+
+    def _write(self, batch):
+        """Insert a batch, or keep the error if that fails"""
+        try:
+            with self.metrics.timer('write', wall = True):
+                self._insert(batch)
+        except Exception as e:
+            print('Could not write tiles to {}: {}'.format(self.path, e))
+            self.error = e
+            try:
+                self.db.rollback()
+            except sqlite3.Error:
+                pass
+
+    def _run(self):
+        """Take tiles off the queue and insert them a batch at a time: once
+           the batch is full, or its first tile has waited flush_interval
+           seconds. After an error, keep taking them off, so that nothing
+           waits forever on a full queue."""
+        batch = []
+        started = None  # when the first tile of the batch came
+        while True:
+            timeout = None
+            if batch:
+                timeout = max(0, started + self.flush_interval
+                              - time.monotonic())
+            try:
+                item = self.queue.get(timeout = timeout)
+            except queue.Empty:
+                item = ()  # the batch has waited long enough
+            if item is None:
+                break
+            if item and not self.error:
+                if not batch:
+                    started = time.monotonic()
+                batch.append(item)
+            if batch and (len(batch) >= self.batch_size or
+                          time.monotonic() - started >= self.flush_interval):
+                self._write(batch)
+                batch = []
+        if batch and not self.error:
+            self._write(batch)
+
+    def extent(self):
+        """Returns ((left, bottom, right, top), minzoom, maxzoom) of the
+           tiles in the file, from the range of columns and rows per zoom.
+           For a new file these are the ranges of the tiles added; for an
+           existing file, the bounds and zooms in its metadata are extended
+           by them. Only an existing file without metadata is read through."""
+        ranges = self.ranges
+        existing = self.resumed or not self.bulk
+        metadata = self.existing_metadata() if existing else {}
+        try:
+            (left, bottom, right, top) = [float(value) for value in
+                                          metadata['bounds'].split(',')]
+            (minz, maxz) = (int(metadata['minzoom']), int(metadata['maxzoom']))
+        except (KeyError, ValueError):
+            (left, bottom, right, top) = (180.0, 85.05113, -180.0, -85.05113)
+            (minz, maxz) = (23, 0)
+            if existing:
+                rows = self.db.execute('''
+                SELECT zoom_level, MIN(tile_column), MAX(tile_column),
+                       MIN(tile_row), MAX(tile_row) FROM {} GROUP BY zoom_level;'''
+                    .format('map' if self.dedupe else 'tiles'))
+                # Flip the TMS rows back to count from the top
+                ranges = merge_ranges(ranges, {
+                    z: (xmin, xmax, 2 ** z - tmsymax - 1, 2 ** z - tmsymin - 1)
+                    for (z, xmin, xmax, tmsymin, tmsymax) in rows})
+        # The corner tiles of each zoom level's range
+        zooms = [z for z in ranges for corner in (0, 1)]
+        tileXs = [ranges[z][corner] for z in ranges for corner in (0, 1)]
+        tileYs = [ranges[z][corner + 2] for z in ranges for corner in (0, 1)]
+        extent = tiles_extent(tileXs, tileYs, zooms)
+        if extent:
+            ((l, b, r, t), zmin, zmax) = extent
+            (left, bottom, right, top) = (min(left, l), min(bottom, b),
+                                          max(right, r), max(top, t))
+            (minz, maxz) = (min(minz, zmin), max(maxz, zmax))
+        return ((left, bottom, right, top), minz, maxz)
+
+    def existing_metadata(self):
+        """The metadata of an existing file, as a dict"""
+        try:
+            return dict(self.db.execute('SELECT name, value FROM metadata;'))
+        except sqlite3.OperationalError:  # No metadata table yet
+            return {}
+
+    def close(self):
+        """Write the remaining tiles and the metadata, and close the file"""
+        self.queue.put(None)
+        self.thread.join()
+        if self.error:
+            self.db.close()
+            raise self.error
+        with self.metrics.timer('write', wall = True):
+            self._finish()
+
+    def _finish(self):
+        """Index the file, write its metadata, and put it in place"""
+        # Tiles with transparency may be PNG among JPEGs; the metadata
+        # can only give one format, so give the one most tiles are in
+        if self.image_file_types:
+            image_file_type = max(self.image_file_types,
+                                  key = self.image_file_types.get)
+        else:
+            image_file_type = self.existing_metadata().get('format', '')
+        if self.bulk:
+            self.create_index()
+        (bounds, minz, maxz) = self.extent()
+        name = os.path.splitext(self.outfile)[0]
+        write_metadata(self.db.cursor(), name, self.opts, image_file_type,
+                       bounds, minz, maxz)
+        self.db.commit()
+        if self.bulk and self.committed:
+            # Readers of the finished file should not need a WAL file
+            self.db.execute('PRAGMA journal_mode=DELETE;')
+        if self.dedupe and self.opts['verbose']:
+            print('{} tiles stored as {} distinct images'
+                  .format(self.count, len(self.tile_ids)))
+        self.db.close()
+        if self.bulk:
+            # Nothing was synced while loading, so make sure the whole file
+            # is on disk before it takes the place of any earlier version
+            with open(self.path, 'rb+') as f:
+                os.fsync(f.fileno())
+            os.replace(self.path, self.outfile)
+
+def write_mbtiles(tiledir, optsin = {}):
+    """Take a folder of tiles in Slippy Map-style schema, return an MBtiles file."""
+    opts = set_defaults(optsin)
+    outfile = tiledir + '.mbtiles'
+    writer = MBTilesWriter(outfile, opts, append = opts['update'])
+    image_files = scandir(tiledir)
+    for image_file in image_files:
+        (image_filename, image_ext) = os.path.splitext(image_file)
+        # Don't add the file to the tileset if it's not an image
+        if(image_ext == '.png' or image_ext == '.jpeg' or image_ext == '.jpg'):
+            # Save a string with the filetype (extension) for use in metadata table
+            #TODO: check if there are multiple file types and throw an error if so
+            image_file_type = image_ext.replace('.','')
+            with open(image_file, "rb") as f:
+                image_blob = f.read()
+            (z, x, y) = path_to_zxy(image_filename)
+            writer.add(z, x, y, image_blob, image_file_type)
+    writer.close()
     
 if __name__ == "__main__":
 